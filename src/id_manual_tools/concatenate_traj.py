@@ -3,6 +3,7 @@ from statistics import mode, StatisticsError
 import matplotlib.pyplot as plt
 import os
 from id_manual_tools import utils
+from id_manual_tools.trajectory_io import load_trajectory, save_trajectory
 from argparse import ArgumentParser
 from rich import print
 
@@ -47,10 +48,9 @@ def arg_main(
     assert all(os.path.exists(session_path) for session_path in session_paths)
     print("Sessions to concatenate:", session_paths)
 
-    main_out = np.load(
-        utils.trajectory_path(session_paths[0], read_only=True),
-        allow_pickle=True,
-    ).item()
+    main_out = load_trajectory(
+        utils.trajectory_path(session_paths[0], read_only=True), mmap_mode="r"
+    )
 
     N = main_out["trajectories"].shape[1]
     main_out["video_path"] = [main_out["video_path"]]
@@ -87,7 +87,7 @@ def arg_main(
         ]["transfer_dicts"]
 
         traj_path = utils.trajectory_path(session_paths[i], read_only=True)
-        data = np.load(traj_path, allow_pickle=True).item()
+        data = load_trajectory(traj_path, mmap_mode="r")
 
         for n in range(N):
             id = n + 1
@@ -166,7 +166,7 @@ def arg_main(
     plt.tight_layout(pad=0.3)
     plt.show()
     fig.savefig(output_path + ".png", dpi=300)
-    np.save(output_path, main_out)
+    save_trajectory(output_path + ".npy", main_out)
     print("Concatenated data saved at", os.path.abspath(output_path + ".npy"))
 
 
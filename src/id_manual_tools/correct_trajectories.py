@@ -1,30 +1,47 @@
-from multiprocessing import Process
+from functools import partial
 from csv import writer as csv_writer
 from argparse import ArgumentParser
 from time import sleep
-import shutil
+from warnings import catch_warnings, simplefilter
 import os
-from functools import lru_cache
 
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 from matplotlib.cm import get_cmap
-from scipy.interpolate import interp1d
 from scipy.spatial.distance import cdist
 import numpy as np
 import cv2
 from rich import print
 from rich.console import Console
 from rich.table import Table
-
-from id_manual_tools.utils import file_path, trajectory_path
+from rich.progress import track
+
+from id_manual_tools.utils import (
+    file_path,
+    trajectory_path,
+    EPISODE_PAD,
+    EPISODE_PAD_EXTRA,
+)
 from id_manual_tools.set_corners import arg_main as set_corners
 from id_manual_tools.matplotlib_gui import matplotlib_gui
-from id_manual_tools.get_nans import get_list_of_nans_from_traj
+from id_manual_tools.get_nans import get_nan_runs
+from id_manual_tools.get_jumps import get_jump_runs
+from id_manual_tools.get_swaps import get_swap_runs
+from id_manual_tools.trajectory_io import load_trajectory, correction_journal
+from id_manual_tools.episode_index import episode_index
+from id_manual_tools.frame_store import frame_cache
+from id_manual_tools.frame_lru import frame_lru
+from id_manual_tools.preloader import prefetcher, sequential_reader
+from id_manual_tools.keyframes import keyframe_index
+from id_manual_tools.trajectory_window import trajectory_window
+from id_manual_tools.gap_filling import episode_interpolator, fill_session_gaps
 
 # from PyQt5.QtWidgets import QToolBar
 console = Console()
 
+# Kinds of the pending episodes, in review order
+EPISODE_KINDS = ("nans", "jumps", "swaps")
+
 
 class trajectory_corrector(matplotlib_gui):
     def __init__(
@@ -33,41 +50,40 @@ class trajectory_corrector(matplotlib_gui):
         traj_path,
         setup_points=None,
         jumps_check_sigma=None,
+        swaps_check_distance=None,
         automatic_check=-1,
         fps=None,
         n_cores=4,
+        cache_dir="Preloaded_frames",
+        cache_size=50,
+        memory_cache=1024,
+        downscale=1,
+        pyramid_levels=2,
     ):
         self.jumps_check_sigma = jumps_check_sigma
+        self.swaps_check_distance = swaps_check_distance
         console.rule("[green]Welcome to the id_manual_tools manual validator")
         self.automatic_check = automatic_check
         self.video_path = os.path.abspath(video_path)
         self.traj_path = os.path.abspath(traj_path)
 
-        self.preloaded_frames_path = os.path.abspath("Preloaded_frames")
-        video_path_file = os.path.join(self.preloaded_frames_path, "video_path.txt")
-
-        os.makedirs(self.preloaded_frames_path, exist_ok=True)
-        try:
-            with open(video_path_file, "r") as file:
-                if file.readline() != self.video_path:
-                    raise FileNotFoundError
-        except FileNotFoundError:
-            print(
-                f"Creating new preloaded frames directory: {self.preloaded_frames_path}"
-            )
-            shutil.rmtree(self.preloaded_frames_path)
-            os.makedirs(self.preloaded_frames_path)
-            with open(video_path_file, "w") as file:
-                file.write(self.video_path)
-        else:
-            print(f"Reusing frames from {self.preloaded_frames_path}")
-
         # TODO ask for an exclusion area with set_corners and set all points inside as nans
         self.cap = cv2.VideoCapture(video_path)
+        self.keyframes = keyframe_index(
+            self.video_path, os.path.dirname(self.traj_path)
+        )
+        self.reader = sequential_reader(video_path, self.keyframes)
+        self.frame_lru = frame_lru(memory_cache)
         print(f"Loaded video {self.video_path}")
 
-        self.data = np.load(self.traj_path, allow_pickle=True).item()
+        # Copy-on-write map: the original file is never modified, corrections
+        # go to an append-only journal replayed on top of it
+        self.data = load_trajectory(
+            self.traj_path, mmap_mode="c", apply_corrections=False
+        )
         print(f"Loaded data  {self.traj_path}")
+        self.journal = correction_journal(self.traj_path)
+        print(f"Replayed {self.journal.replay(self.data)} corrections")
 
         if setup_points is not None:
             try:
@@ -78,7 +94,12 @@ class trajectory_corrector(matplotlib_gui):
                 print(
                     f"Setup_points setter is launched to define the user required setup_points {setup_points}"
                 )
-                set_corners(self.video_path, self.data)
+                set_corners(
+                    self.video_path,
+                    self.data,
+                    memory_cache=memory_cache,
+                    keyframes=self.keyframes,
+                )
 
                 try:
                     exist_required_setup_points = (
@@ -88,15 +109,19 @@ class trajectory_corrector(matplotlib_gui):
                     exist_required_setup_points = False
 
             corners = self.data["setup_points"][setup_points]
-            self.xmin = int(np.min(corners[:, 0]))
-            self.xmax = int(np.max(corners[:, 0]))
-            self.ymin = int(np.min(corners[:, 1]))
-            self.ymax = int(np.max(corners[:, 1]))
+            self.xmin = max(0, int(np.min(corners[:, 0])))
+            self.xmax = min(
+                int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(np.max(corners[:, 0]))
+            )
+            self.ymin = max(0, int(np.min(corners[:, 1])))
+            self.ymax = min(
+                int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(np.max(corners[:, 1]))
+            )
         else:
             self.xmin = 0
-            self.xmax = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+            self.xmax = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             self.ymin = 0
-            self.ymax = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            self.ymax = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
         if fps:
             if fps != self.data["frames_per_second"]:
@@ -106,24 +131,45 @@ class trajectory_corrector(matplotlib_gui):
         self.total_frames, self.N = self.data["trajectories"].shape[:2]
         assert self.total_frames == self.cap.get(cv2.CAP_PROP_FRAME_COUNT)
 
+        self.downscale = downscale
+        self.lims = (self.xmin, self.xmax, self.ymin, self.ymax, self.downscale)
+        # Frames are stored at full and reduced resolutions (for zoomed out views)
+        self.frame_store = frame_cache(cache_dir, cache_size * 1e9).open_pyramid(
+            self.video_path,
+            self.total_frames,
+            self.frame_shape(*self.lims),
+            {
+                "crop": [self.xmin, self.xmax, self.ymin, self.ymax],
+                "downscale": self.downscale,
+                "process": "trajectory_corrector.process_image/uint16",
+            },
+            levels=pyramid_levels,
+        )
+
         self.N -= 1
 
-        copy_of_traj = np.zeros_like(self.data["trajectories"])
         if jumps_check_sigma is not None:
-            vel = np.linalg.norm(np.diff(self.data["trajectories"], axis=0), axis=2)
-            impossible_jumps = vel > (
-                np.nanmean(vel) + jumps_check_sigma * np.nanstd(vel)
-            )
-            copy_of_traj[:-1][impossible_jumps] = np.nan
-            print(f"Number of impossible jumps: {np.sum(impossible_jumps)}")
-            self.list_of_jumps = get_list_of_nans_from_traj(
-                copy_of_traj, sort_by="start"
+            jumps = get_jump_runs(
+                self.data["trajectories"], jumps_check_sigma, sort_by=None
             )
+            print(f"Number of impossible jumps: {jumps['duration'].sum()}")
+            self.pending_jumps = episode_index(jumps.tolist())
         else:
-            self.list_of_jumps = []
+            self.pending_jumps = episode_index()
+
+        # Close approaches are reviewed on the lower fish id of the pair
+        self.pending_swaps = episode_index()
+        if swaps_check_distance is not None:
+            swaps = get_swap_runs(
+                self.data["trajectories"],
+                swaps_check_distance * self.data["body_length"],
+            )
+            print(f"Number of close approaches (possible identity swaps): {len(swaps)}")
+            for fish_id, _, start, end, _ in swaps.tolist():
+                self.pending_swaps.add(fish_id, start, end)
 
-        self.list_of_nans = get_list_of_nans_from_traj(
-            self.data["trajectories"], sort_by="start"
+        self.pending_nans = episode_index(
+            get_nan_runs(self.data["trajectories"], sort_by=None).tolist()
         )
 
         self.write_lists_of_nans_and_jumps()
@@ -132,65 +178,102 @@ class trajectory_corrector(matplotlib_gui):
         print(f"ymin => ymax = {self.ymin} => {self.ymax}")
         # self.Lx = 0.5 * (self.xmax - self.xmin)
         # self.Ly = 0.5 * (self.ymax - self.ymin)
-        self.pad = 7
-        self.pad_extra = 150
-        self.actual_plotted_frame = -1
-        self.G_pressed = False
+        self.pad = EPISODE_PAD
+        self.pad_extra = EPISODE_PAD_EXTRA
+        self.trail_length = 30  # frames
+        self.lookahead = 3  # episodes prefetched with priority
+        self.plotted_image = None  # (frame, pyramid level)
 
         self.key_w()  # Save corners and other extra thing before start the app
 
-        if self.list_of_nans or self.list_of_jumps:
-            list_of_frames_to_preload = set()
-            for id, start, end, duration in self.list_of_nans + self.list_of_jumps:
-                if duration <= self.automatic_check:
-                    list_of_frames_to_preload.add(max(0, start - 1))
-                else:
-                    pad = min(self.pad, duration)
-                    for frame in range(
-                        max(0, start - pad), min(self.total_frames, end + pad)
-                    ):
-                        list_of_frames_to_preload.add(frame)
-            list_of_frames_to_preload = list(list_of_frames_to_preload)
-            print(f"{len(list_of_frames_to_preload)} frames needed")
-            list_of_frames_to_preload = [
-                frame
-                for frame in list_of_frames_to_preload
-                if not os.path.exists(
-                    os.path.join(self.preloaded_frames_path, f"{frame}.npz")
-                )
-            ]
-            print(f"{len(list_of_frames_to_preload)} frames to preload")
-            if list_of_frames_to_preload:
-                self.preload_frames_list(
-                    sorted(list_of_frames_to_preload), n_cores=n_cores
-                )
+        # Episodes are reviewed in this order (see EPISODE_KINDS)
+        self.pending_episodes = (
+            self.pending_nans,
+            self.pending_jumps,
+            self.pending_swaps,
+        )
+        self.kind = None  # kind of the episode under review
+        if any(self.pending_episodes):
+            # Frames are loaded in the background in episode order while the
+            # GUI runs, the current and next episodes go first
+            self.prefetcher = prefetcher(
+                self.frame_store,
+                self.video_path,
+                trajectory_corrector.process_image,
+                self.lims,
+                n_workers=n_cores,
+                keyframes=self.keyframes,
+            )
+            self.prefetcher.request(
+                self.episode_frames(start, end, kind)
+                for kind, pending in zip(EPISODE_KINDS, self.pending_episodes)
+                for _, start, end, _ in pending
+            )
+            print(f"{len(self.prefetcher.queued)} frames to preload in background")
 
             self.create_figure()
 
-            if self.list_of_nans:
-                self.next_episode(self.list_of_nans.pop(-1))
-            elif self.list_of_jumps:
-                self.next_episode(self.list_of_jumps.pop(-1))
+            self.next_episode(*self.pop_episode())
 
             plt.show()
+            self.prefetcher.close()
+            print(f"Frames in memory: {self.frame_lru}")
         else:
-            if jumps_check_sigma is not None:
-                print("[red]There's no nans nor impossible jumps to correct")
+            if jumps_check_sigma is not None or swaps_check_distance is not None:
+                print("[red]There's no nans, impossible jumps nor swaps to correct")
             else:
                 print("[red]There's no nans to correct")
-
-    def next_episode(self, params):
+        self.frame_store.close()
+
+    def episode_frames(self, start, end, kind="nans"):
+        """Frames displayed while correcting an episode"""
+        if self.auto_validated(start, end, kind):
+            return [max(0, start - 1)]
+        pad = min(self.pad, end - start)
+        return range(max(0, start - pad), min(self.total_frames, end + pad))
+
+    def auto_validated(self, start, end, kind):
+        """Short episodes are accepted without review, except possible swaps"""
+        return kind != "swaps" and (end - start) <= self.automatic_check
+
+    def pop_episode(self):
+        """(kind, episode) of the next pending episode or None"""
+        for kind, pending in zip(EPISODE_KINDS, self.pending_episodes):
+            if pending:
+                return kind, pending.pop()
+        return None
+
+    def next_episode(self, kind, params):
+        self.kind = kind
         self.id, self.start, self.end, _ = params
 
-        console.rule(
-            f"[bold red]Episode for fish {self.id} from {self.start} to {self.end}, {self.end-self.start} nans"
+        upcoming = []
+        for upcoming_kind, pending in zip(EPISODE_KINDS, self.pending_episodes):
+            upcoming += [
+                (upcoming_kind, start, end)
+                for _, start, end, _ in pending.peek(self.lookahead - len(upcoming))
+            ]
+        self.prefetcher.request(
+            [self.episode_frames(self.start, self.end, kind)]
+            + [self.episode_frames(start, end, k) for k, start, end in upcoming],
+            priority=True,
         )
-        self.id_traj = self.data["trajectories"][:, self.id, :]
-        self.traj = np.delete(self.data["trajectories"], self.id, axis=1)
 
-        if self.N:
-            temp = self.traj.reshape(-1, self.N, 1, 2)
-            self.segments = np.concatenate([temp[:-1], temp[1:]], axis=2)
+        self.id_traj = self.data["trajectories"][:, self.id, :]
+        self.others = trajectory_window(
+            self.data["trajectories"], self.id, trail=self.trail_length
+        )
+        if kind == "swaps":
+            self.partner = self.closest_fish(self.start, self.end)
+            console.rule(
+                f"[bold red]Possible swap of fish {self.id} and {self.partner} from {self.start} to {self.end}"
+            )
+            print("Press i to swap their identities from the actual frame, enter to accept")
+        else:
+            self.partner = None
+            console.rule(
+                f"[bold red]Episode for fish {self.id} from {self.start} to {self.end}, {self.end-self.start} nans"
+            )
 
         self.frame = max(0, self.start - 1)
 
@@ -199,71 +282,117 @@ class trajectory_corrector(matplotlib_gui):
         if not np.isnan(self.id_traj[self.frame, 0]):
             self.x_center, self.y_center = self.id_traj[self.frame]
         else:
-            self.x_center, self.y_center = np.nanmean(self.traj[self.frame], axis=0)
+            self.x_center, self.y_center = np.nanmean(
+                self.others.positions(self.frame), axis=0
+            )
         self.set_ax_lims(draw=False)
-        self.interpolation_range = np.arange(self.start, self.end)
-        self.continuous_interpolation_range = np.arange(
-            self.start - 1, self.end + 0.1, 0.2
+        # Possible swaps are not interpolated, only accepted or swapped
+        self.interpolation_range = np.arange(
+            self.start, self.start if kind == "swaps" else self.end
         )
 
         self.user_detection_history = []
+        self.edited_range = (self.start, self.end)
 
+        self.interpolator = episode_interpolator(self.id_traj)
         self.fit_interpolator_and_draw_frame()
 
-        if (self.end - self.start) <= self.automatic_check:
+        if self.auto_validated(self.start, self.end, kind):
             sleep(0.1)
             self.key_enter()
 
-    def preload_frames_list(self, list_of_frames, n_cores=10):
-
-        n_frames = len(list_of_frames)
-        chunks = max(50, n_frames // n_cores)
-        print(
-            f"[red]Starting {len(range(0, n_frames, chunks))} processes of {chunks} frames each"
-        )
-
-        for s in range(0, n_frames, chunks):
-            Process(
-                target=trajectory_corrector.process_frame_list_and_save,
-                args=(
-                    self.preloaded_frames_path,
-                    self.video_path,
-                    list_of_frames[s : s + chunks],
-                    trajectory_corrector.process_image,
-                    (self.xmin, self.xmax, self.ymin, self.ymax),
-                ),
-            ).start()
+    def closest_fish(self, start, end):
+        """Fish (other than the current one) closest on average in [start, end)"""
+        traj = self.data["trajectories"][start:end]
+        distances = np.linalg.norm(traj - traj[:, self.id : self.id + 1], axis=2)
+        distances[:, self.id] = np.nan
+        with catch_warnings():  # fish without positions in the episode
+            simplefilter("ignore", category=RuntimeWarning)
+            mean_distances = np.nanmean(distances, axis=0)
+        mean_distances[np.isnan(mean_distances)] = np.inf
+        return int(np.argmin(mean_distances))
 
     def draw_frame(self):
 
-        self.points.set_offsets(self.traj[self.frame])
+        self.points.set_offsets(self.others.positions(self.frame))
         if self.frame in self.interpolation_range:
             self.id_point.set_offsets(self.interpolator(self.frame))
         else:
             self.id_point.set_offsets(self.id_traj[self.frame])
-        self.interpolated_points.set_data(self.interpolator(self.interpolation_range))
-        self.interpolated_line.set_data(
-            self.interpolator(self.continuous_interpolation_range)
-        )
 
-        self.interpolated_train.set_data(*self.interpolator.y)
+        if self.kind == "swaps":
+            self.partner_point.set_offsets(
+                self.data["trajectories"][self.frame, self.partner]
+            )
+            for artist in (
+                self.interpolated_points,
+                self.interpolated_line,
+                self.interpolated_train,
+            ):
+                artist.set_data([], [])
+        else:
+            self.partner_point.set_offsets(np.empty((0, 2)))
+            self.interpolated_points.set_data(
+                self.interpolator.at_range(self.start, self.end)
+            )
+            self.interpolated_line.set_data(
+                self.interpolator.at_range(self.start - 1, self.end + 0.1, 0.2)
+            )
 
-        if self.frame != self.actual_plotted_frame:
-            self.im.set_data(self.get_frame(self.frame))
+            self.interpolated_train.set_data(*self.interpolator.y)
 
-            self.text.set_text(f"Frame {self.frame}")
-            self.actual_plotted_frame = self.frame
+        self.update_image()
 
-        origin = max(0, self.frame - 30)
+        segments = self.others.segments(self.frame)
         for fish in range(self.N):
-            self.LineCollections[fish].set_segments(
-                self.segments[origin : self.frame, fish]
-            )
-        self.draw_and_flush()
+            self.LineCollections[fish].set_segments(segments[:, fish])
+        self.blit_and_flush()
+
+    def update_image(self):
+        level = self.pyramid_level()
+        if (self.frame, level) == self.plotted_image:
+            return
+        image = self.get_frame(self.frame, block=False, level=level)
+        if image is None:
+            # Keep the previous image until the frame is loaded in background
+            self.prefetcher.request([[self.frame]], priority=True)
+            self.text.set_text(f"Frame {self.frame} (loading)")
+            self.loading_timer.start()
+        else:
+            self.im.set_data(image)
+            self.text.set_text(f"Frame {self.frame}")
+            self.plotted_image = (self.frame, level)
+
+    def pyramid_level(self):
+        """Lowest resolution level with pixels not smaller than screen pixels"""
+        data_per_screen_pixel = 2 * self.zoom * self.Lx / self.canvas_size[0]
+        level = int(np.log2(max(1, data_per_screen_pixel / self.downscale)))
+        return min(level, self.frame_store.levels)
+
+    def set_ax_lims(self, draw=True):
+        super().set_ax_lims(draw=False)
+        if self.plotted_image is not None:
+            self.update_image()  # the zoom may need another pyramid level
+        if draw:
+            self.fig.canvas.draw()
+
+    def on_loading_timer(self):
+        """Draws the frame once loaded in background (or loads it here if the
+        background load failed)"""
+        status = self.prefetcher.status(self.frame)
+        if status == "loading":
+            return
+        self.loading_timer.stop()
+        if status == "missing":
+            self.get_frame(self.frame)
+        self.draw_frame()
 
     def create_figure(self):
         super().__init__("Trajectory correction")
 
+        self.loading_timer = self.fig.canvas.new_timer(interval=50)
+        self.loading_timer.add_callback(self.on_loading_timer)
+
         (self.interpolated_line,) = self.ax.plot([], [], "w-", zorder=8)
         (self.interpolated_points,) = self.ax.plot([], [], "w.", zorder=8)
         (self.interpolated_train,) = self.ax.plot([], [], "r.", zorder=9)
@@ -293,36 +422,36 @@ class trajectory_corrector(matplotlib_gui):
         )
 
         self.id_point = self.ax.scatter([], [], c="k", s=10.0, zorder=10)
+        self.partner_point = self.ax.scatter(
+            [], [], facecolors="none", edgecolors="w", s=60.0, zorder=10
+        )
         self.text = self.ax.text(
             0.1, 0.1, "", size=15, zorder=15, transform=self.ax.transAxes
         )
 
-        line_lenght = 30
         self.LineCollections = []
         for i in range(self.N):
-            color = np.tile(cmap(i / (max(1, self.N - 1))), (line_lenght, 1))
-            color[:, -1] = np.linspace(0, 1, line_lenght)
+            color = np.tile(cmap(i / (max(1, self.N - 1))), (self.trail_length, 1))
+            color[:, -1] = np.linspace(0, 1, self.trail_length)
             self.LineCollections.append(LineCollection([], linewidths=2, color=color))
 
         for linecollection in self.LineCollections:
             self.ax.add_collection(linecollection)
 
-    def fit_interpolator_and_draw_frame(self):
-
-        time_range = np.arange(
-            max(0, self.start - (self.pad + self.pad_extra)),
-            min(self.total_frames, self.end + (self.pad + self.pad_extra)),
+        self.add_animated(
+            self.im,
+            self.interpolated_line,
+            self.interpolated_points,
+            self.interpolated_train,
+            self.points,
+            self.id_point,
+            self.partner_point,
+            self.text,
+            *self.LineCollections,
         )
 
-        time_range = time_range[~np.isnan(self.id_traj[time_range, 0])]
-
-        self.interpolator = interp1d(
-            time_range,
-            self.id_traj[time_range].T,
-            axis=1,
-            kind="cubic",
-            fill_value="extrapolate",
-        )
+    def fit_interpolator_and_draw_frame(self):
+        self.interpolator.set_episode(self.start, self.end, self.pad + self.pad_extra)
         self.draw_frame()
 
     def key_a(self, draw=True):
@@ -356,10 +485,10 @@ class trajectory_corrector(matplotlib_gui):
 
     def key_p(self):
         """Toggle 150 extra time steps in the interpolator data"""
-        if self.pad_extra == 150:
+        if self.pad_extra == EPISODE_PAD_EXTRA:
             self.pad_extra = 0
         else:
-            self.pad_extra = 150
+            self.pad_extra = EPISODE_PAD_EXTRA
 
         self.fit_interpolator_and_draw_frame()
 
@@ -368,6 +497,7 @@ class trajectory_corrector(matplotlib_gui):
         if self.user_detection_history:
             frame, position = self.user_detection_history.pop()
             self.id_traj[frame] = position
+            self.interpolator.changed(frame)
 
             self.fit_interpolator_and_draw_frame()
 
@@ -388,6 +518,9 @@ class trajectory_corrector(matplotlib_gui):
                 self.id_traj[
                     max(0, self.frame - self.Delta + 1) : self.frame + 1
                 ] = np.nan
+                self.interpolator.changed(
+                    max(0, self.frame - self.Delta + 1), self.frame + 1
+                )
                 while np.isnan(self.id_traj[self.frame, 0]):
                     self.start -= 1
                     self.frame -= 1
@@ -398,6 +531,7 @@ class trajectory_corrector(matplotlib_gui):
                 self.id_traj[
                     self.frame : min(self.total_frames, self.frame + self.Delta)
                 ] = np.nan
+                self.interpolator.changed(self.frame, self.frame + self.Delta)
                 while np.isnan(self.id_traj[self.frame, 0]):
                     self.end += 1
                     self.frame += 1
@@ -405,9 +539,6 @@ class trajectory_corrector(matplotlib_gui):
                         break
 
             self.interpolation_range = np.arange(self.start, self.end)
-            self.continuous_interpolation_range = np.arange(
-                self.start - 1, self.end + 0.1, 0.2
-            )
             self.fit_interpolator_and_draw_frame()
 
         elif (self.end - self.frame) < self.Delta:
@@ -415,16 +546,20 @@ class trajectory_corrector(matplotlib_gui):
             self.id_traj[
                 self.frame : min(self.total_frames, self.frame + self.Delta)
             ] = np.nan
+            self.interpolator.changed(self.frame, self.frame + self.Delta)
+            self.mark_edited(self.frame, self.frame + self.Delta)
 
             while np.isnan(self.id_traj[self.frame, 0]):
                 self.frame += 1
                 if self.frame == (self.total_frames - 1):
                     break
             self.end = self.frame
+            self.interpolation_range = np.arange(self.start, self.end)
 
             self.fit_interpolator_and_draw_frame()
         elif self.frame in self.interpolation_range:
             self.id_traj[self.frame] = np.nan
+            self.interpolator.changed(self.frame)
             self.fit_interpolator_and_draw_frame()
 
         else:
@@ -433,47 +568,106 @@ class trajectory_corrector(matplotlib_gui):
                 f"You only can set nan values on frames {self.start-1} and {self.end}"
             )
 
+    def mark_edited(self, start, end):
+        """Extends the range of frames of the current fish modified in this episode"""
+        self.edited_range = (
+            max(0, min(self.edited_range[0], start)),
+            min(self.total_frames, max(self.edited_range[1], end)),
+        )
+
     def key_enter(self):
-        """Accept the interpolation, write it to the trajectory array and move on (this doesn't write on disk)"""
+        """Accept the interpolation, write it to the trajectory array and move on (this doesn't write on disk). Possible swaps are accepted as they are"""
+        if self.kind == "swaps":
+            print(
+                f"Accepted fish {self.id} and {self.partner} from {self.start} to {self.end}"
+            )
+        else:
+            self.write_interpolation()
+
+        episode = self.pop_episode()
+        if episode is not None:
+            self.next_episode(*episode)
+        else:
+            self.key_w()
+            plt.close()
+
+    def write_interpolation(self):
         print(
             f"Writing interpolation into the array from {self.start} to {self.end} for fish {self.id}"
         )
-        self.id_traj[self.interpolation_range] = self.interpolator(
-            self.interpolation_range
+        self.id_traj[self.interpolation_range] = self.interpolator.at_range(
+            self.start, self.end
         ).T
 
-        self.list_of_nans = get_list_of_nans_from_traj(
-            self.data["trajectories"], sort_by="start"
-        )
+        self.mark_edited(self.start, self.end)
+        start, end = self.edited_range
+        self.journal.append_positions(self.id, start, self.id_traj[start:end])
+
+        # Only the edited window can have changed its nans
+        self.pending_nans.remove(self.id, start, end)
+        for _, nan_start, nan_end, _ in get_nan_runs(
+            self.id_traj[start:end, 0], sort_by=None
+        ).tolist():
+            self.pending_nans.add(self.id, start + nan_start, start + nan_end)
+
+    def key_i(self):
+        """Swap the identities of the fish and its partner from the actual frame to the end of the video (possible swaps only)"""
+        if self.kind != "swaps":
+            print("[red]Identities can only be swapped while reviewing a possible swap")
+            return
+        pair = [self.id, self.partner]
+        trajectories = self.data["trajectories"]
+        trajectories[self.frame :, pair] = trajectories[self.frame :, pair[::-1]]
+        for fish in pair:
+            self.journal.append_positions(
+                fish, self.frame, trajectories[self.frame :, fish]
+            )
 
-        if self.list_of_nans:
-            self.next_episode(self.list_of_nans.pop(-1))
-        elif self.list_of_jumps:
-            self.next_episode(self.list_of_jumps.pop(-1))
-        else:
-            self.key_w()
-            plt.close()
+        # Pending episodes of both fish follow their new identities
+        for pending in self.pending_episodes:
+            moved = [
+                (fish_id, max(start, self.frame), end)
+                for fish_id, start, end, _ in pending
+                if fish_id in pair and end > self.frame
+            ]
+            for fish in pair:
+                pending.remove(fish, self.frame, self.total_frames)
+            for fish_id, start, end in moved:
+                pending.add(pair[fish_id == pair[0]], start, end)
+
+        print(f"Swapped fish {self.id} and {self.partner} from frame {self.frame}")
+        self.others = trajectory_window(trajectories, self.id, trail=self.trail_length)
+        self.draw_frame()
 
     def key_w(self):
         """Write on disk the actual state of the trajectory array"""
-        print(f"Saving data to {self.traj_path}")
-        np.save(self.traj_path, self.data)
+        print(f"Saving corrections to {self.journal.path}")
+        self.journal.set_entry("frames_per_second", self.data["frames_per_second"])
+        self.journal.set_entry("setup_points", self.data["setup_points"])
+        self.journal.sync()
         self.write_lists_of_nans_and_jumps()
 
     def write_lists_of_nans_and_jumps(self):
         with open("list_of_nans.csv", "w", newline="") as csvfile:
             csvfile.write("fish_id,start,end,duration\n")
             writer = csv_writer(csvfile)
-            writer.writerows(self.list_of_nans)
+            writer.writerows(self.pending_nans)
         print(f"List of nans saved at {os.path.abspath('list_of_nans.csv')}")
 
         if self.jumps_check_sigma is not None:
             with open("list_of_jumps.csv", "w", newline="") as csvfile:
                 csvfile.write("fish_id,start,end,duration\n")
                 writer = csv_writer(csvfile)
-                writer.writerows(self.list_of_jumps)
+                writer.writerows(self.pending_jumps)
             print(f"List of jumps saved at {os.path.abspath('list_of_jumps.csv')}")
 
+        if self.swaps_check_distance is not None:
+            with open("list_of_swaps.csv", "w", newline="") as csvfile:
+                csvfile.write("fish_id,start,end,duration\n")
+                writer = csv_writer(csvfile)
+                writer.writerows(self.pending_swaps)
+            print(f"List of swaps saved at {os.path.abspath('list_of_swaps.csv')}")
+
     def key_g(self):
         """Apply key d and key x sequentially"""
         self.key_d(draw=False)
@@ -489,11 +683,37 @@ class trajectory_corrector(matplotlib_gui):
 
     def key_G(self):
         """Apply key g until the end of the episode is reached"""
-        self.G_pressed = not self.G_pressed
-        while self.G_pressed:
-            self.key_g()
-            if self.frame >= self.end:
-                self.G_pressed = False
+        frames = range(self.frame + self.Delta, self.end, self.Delta)
+        last = frames[-1] if frames else self.frame
+
+        # Track the blob from its last position (at constant velocity) without
+        # refitting nor drawing, the interpolator is fitted once at the end
+        known = self.id_traj[self.frame]
+        known_frame = self.frame
+        velocity = np.zeros(2)
+        for frame in track(
+            frames,
+            description="Snapping to blobs",
+            transient=True,
+            disable=len(frames) < 100,
+        ):
+            if frame not in self.interpolation_range:
+                continue
+            if np.isnan(known[0]):
+                guess = self.interpolator(frame)
+            else:
+                guess = known + velocity * (frame - known_frame)
+            position = self.nearest_blob(frame, *guess)
+            if position is None:
+                continue
+            position = np.array(position)
+            if not np.isnan(known[0]):
+                velocity = (position - known) / (frame - known_frame)
+            known, known_frame = position, frame
+            self.set_position(frame, position)
+
+        self.frame = min(self.total_frames - 1, last + self.Delta)
+        self.key_c(draw=False)
         self.draw_frame()
 
     def key_number(self, number):
@@ -518,6 +738,7 @@ class trajectory_corrector(matplotlib_gui):
             "g",
             "G",
             "enter",
+            "i",
             "w",
             "h",
         ]
@@ -546,44 +767,78 @@ class trajectory_corrector(matplotlib_gui):
         if self.frame in self.interpolation_range:
             self.find_blob(*self.interpolator(self.frame))
 
-    @lru_cache(maxsize=1024)
-    def get_frame(self, frame):
-        path = os.path.join(self.preloaded_frames_path, f"{frame}.npz")
-        if os.path.exists(path):
-            return np.load(path)["arr_0"]
+    def get_frame(self, frame, block=True, level=0):
+        """Processed frame (at a pyramid level) from memory, from the frame
+        store or decoded here. With block=False, None is returned instead of
+        decoding"""
+        return self.frame_lru.get(
+            (frame, level), partial(self.load_frame, block=block)
+        )
 
-        print(f"[red]Had to load frame {frame}")
-        if self.cap.get(cv2.CAP_PROP_POS_FRAMES) != frame:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-        ret, image = self.cap.read()
-        assert ret
+    def load_frame(self, key, block=True):
+        frame, level = key
+        image = self.frame_store.get(frame, level)
+        if image is None:
+            if not block:
+                return None
+            print(f"[red]Had to load frame {frame}")
+            self.frame_store.allocate([frame])
+            self.frame_store.write(
+                frame, self.process_image(self.reader.read(frame), *self.lims)
+            )
+            image = self.frame_store.get(frame, level)
+        return np.array(image)
 
-        image = self.process_image(image, self.xmin, self.xmax, self.ymin, self.ymax)
-        return image
+    @staticmethod
+    def frame_shape(xmin, xmax, ymin, ymax, downscale=1):
+        return (
+            max(1, round((ymax - ymin) / downscale)),
+            max(1, round((xmax - xmin) / downscale)),
+        )
 
     @staticmethod
-    def process_image(image, xmin, xmax, ymin, ymax):
-        image = np.mean(image[ymin:ymax, xmin:xmax], axis=-1)
-        image -= np.min(image)
-        image *= 255 / np.max(image)
-        image = np.uint8(image)
-        return image
+    def process_image(image, xmin, xmax, ymin, ymax, downscale=1):
+        """Cropped grayscale (mean of the channels) uint8 image with its
+        contrast stretched to [0, 255], in integer arithmetic: the sum of
+        the channels (uint16) goes through a lookup table"""
+        crop = image[ymin:ymax, xmin:xmax]
+        gray = crop[..., 0].astype(np.uint16)
+        gray += crop[..., 1]
+        gray += crop[..., 2]
+        if downscale != 1:
+            height, width = trajectory_corrector.frame_shape(
+                xmin, xmax, ymin, ymax, downscale
+            )
+            gray = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
 
-    def find_blob(self, x, y):
+        low, high = int(gray.min()), int(gray.max())
+        lut = np.zeros(high + 1, np.uint8)
+        if high > low:
+            lut[low:] = np.arange(high - low + 1) * 255 // (high - low)
+        return lut[gray]
+
+    def nearest_blob(self, frame, x, y):
+        """Position of the blob closest to (x, y) in frame, or None"""
         if x <= self.xmin or x >= self.xmax or y >= self.ymax or y <= self.ymin:
-            return
+            return None
+
+        # Coordinates in pixels of the processed (cropped, downscaled) frame
+        d = self.downscale
+        x_px = (x - self.xmin + 0.5) / d - 0.5
+        y_px = (y - self.ymin + 0.5) / d - 0.5
+        radius = self.data["body_length"] / d
 
-        canvas_x_min = max(0, int(x - self.data["body_length"] - self.xmin))
-        canvas_y_min = max(0, int(y - self.data["body_length"] - self.ymin))
+        canvas_x_min = max(0, int(x_px - radius))
+        canvas_y_min = max(0, int(y_px - radius))
 
-        canvas_center = (x - canvas_x_min - self.xmin, y - canvas_y_min - self.ymin)
+        canvas_center = (x_px - canvas_x_min, y_px - canvas_y_min)
 
-        fish_im = self.get_frame(self.frame)[
-            canvas_y_min : int(y + self.data["body_length"] - self.ymin),
-            canvas_x_min : int(x + self.data["body_length"] - self.xmin),
+        fish_im = self.get_frame(frame)[
+            canvas_y_min : int(y_px + radius),
+            canvas_x_min : int(x_px + radius),
         ]
 
-        fish_im = cv2.GaussianBlur(fish_im, (0, 0), 2)
+        fish_im = cv2.GaussianBlur(fish_im, (0, 0), 2 / d)
 
         _, mask = cv2.threshold(
             fish_im,
@@ -604,7 +859,10 @@ class trajectory_corrector(matplotlib_gui):
         blobs_positions = []
         for c in contours:
             M = cv2.moments(c)
-            blobs_positions.append((M["m10"] / M["m00"], M["m01"] / M["m00"]))
+            if M["m00"]:
+                blobs_positions.append((M["m10"] / M["m00"], M["m01"] / M["m00"]))
+        if not blobs_positions:
+            return None
 
         closer_blob = cdist(
             [
@@ -622,23 +880,28 @@ class trajectory_corrector(matplotlib_gui):
         # ax.plot(x_c, y_c, "g.")
         # fig.savefig("id_dev/fish", dpi=300)
 
-        self.user_detection_history.append(
-            (self.frame, tuple(self.id_traj[self.frame]))
+        return (
+            (x_c + canvas_x_min + 0.5) * d - 0.5 + self.xmin,
+            (y_c + canvas_y_min + 0.5) * d - 0.5 + self.ymin,
         )
-        self.id_traj[self.frame] = (
-            x_c + canvas_x_min + self.xmin,
-            y_c + canvas_y_min + self.ymin,
-        )
-        self.fit_interpolator_and_draw_frame()
+
+    def set_position(self, frame, position):
+        self.user_detection_history.append((frame, tuple(self.id_traj[frame])))
+        self.mark_edited(frame, frame + 1)
+        self.id_traj[frame] = position
+        self.interpolator.changed(frame)
+
+    def find_blob(self, x, y):
+        position = self.nearest_blob(self.frame, x, y)
+        if position is not None:
+            self.set_position(self.frame, position)
+            self.fit_interpolator_and_draw_frame()
 
     def button_3(self, event):
         self.find_blob(event.xdata, event.ydata)
 
     def button_1(self, event):
-        self.user_detection_history.append(
-            (self.frame, tuple(self.id_traj[self.frame]))
-        )
-        self.id_traj[self.frame] = event.xdata, event.ydata
+        self.set_position(self.frame, (event.xdata, event.ydata))
         self.fit_interpolator_and_draw_frame()
 
     def on_key(self, event):
@@ -653,25 +916,6 @@ class trajectory_corrector(matplotlib_gui):
             except AttributeError:
                 pass
 
-    @staticmethod
-    def process_frame_list_and_save(
-        save_dir, video_path, list_of_frames, process_fun, lims
-    ):
-        # cv2.setNumThreads(1)
-        cap = cv2.VideoCapture(video_path)
-        for frame in list_of_frames:
-            if cap.get(cv2.CAP_PROP_POS_FRAMES) != frame:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-            ret, image = cap.read()
-            assert ret
-            np.savez_compressed(
-                os.path.join(save_dir, f"{frame}"),
-                process_fun(image, *lims),
-            )
-        print(
-            f"Preloaded episode with frames {list_of_frames[0]} => {list_of_frames[-1]}"
-        )
-
 
 def main():
     parser = ArgumentParser(
@@ -692,7 +936,13 @@ def main():
     parser.add_argument(
         "-jumps_check_sigma",
         type=float,
-        help="Check for impossible long jumps on the trajectories",
+        help="Check for impossible long jumps on the trajectories (over median + sigma * MAD of the speed of each fish)",
+    )
+
+    parser.add_argument(
+        "-swaps_check_distance",
+        type=float,
+        help="Review close approaches between fish (closer than this number of body lengths) as possible identity swaps",
     )
 
     parser.add_argument(
@@ -709,6 +959,13 @@ def main():
         help="Max length of nan episode to apply auto-correction",
     )
 
+    parser.add_argument(
+        "-headless",
+        action="store_true",
+        default=False,
+        help="Auto-correct the nan episodes up to -auto_validation frames without the GUI and exit",
+    )
+
     parser.add_argument(
         "-fps",
         default=0,
@@ -722,16 +979,56 @@ def main():
         help="number of threads for parallel processing. Default is 4",
     )
 
+    parser.add_argument(
+        "-cache",
+        type=str,
+        default="Preloaded_frames",
+        help="Directory of preloaded frames, shared between sessions and videos. Default is ./Preloaded_frames",
+    )
+    parser.add_argument(
+        "-cache_size",
+        type=float,
+        default=50,
+        help="Disk budget of the preloaded frames directory in GB (least recently used videos are removed). Default is 50",
+    )
+
+    parser.add_argument(
+        "-memory_cache",
+        type=float,
+        default=1024,
+        help="Memory budget for frames kept in RAM by the GUI, in MB. Default is 1024",
+    )
+
+    parser.add_argument(
+        "-downscale",
+        type=int,
+        default=1,
+        help="Downscale factor of the frames shown in the GUI (2 is half resolution), it reduces the preloaded frames size. Default is 1",
+    )
+
     args = parser.parse_args()
 
+    traj_path = trajectory_path(args.s, reset=args.reset, read_only=True)
+    if args.reset:
+        correction_journal(traj_path).clear()
+
+    if args.headless:
+        fill_session_gaps(traj_path, args.auto_validation, n_cores=args.n)
+        return
+
     trajectory_corrector(
         args.video,
-        trajectory_path(args.s, reset=args.reset),
+        traj_path,
         jumps_check_sigma=args.jumps_check_sigma,
+        swaps_check_distance=args.swaps_check_distance,
         automatic_check=args.auto_validation,
         setup_points="corners_out",
         fps=args.fps,
         n_cores=args.n,
+        cache_dir=args.cache,
+        cache_size=args.cache_size,
+        memory_cache=args.memory_cache,
+        downscale=args.downscale,
     )
 
 
@@ -0,0 +1,107 @@
+import heapq
+from bisect import bisect_left, bisect_right
+
+
+class episode_index:
+    """Pending correction episodes (fish_id, start, end) stored as sorted,
+    non-overlapping intervals per fish plus a heap ordered by start frame.
+
+    Filling, splitting or extending an episode only touches the intervals of
+    one fish (binary search plus the few intervals affected) instead of
+    rescanning the whole trajectory.
+    """
+
+    def __init__(self, runs=()):
+        """runs is an iterable of (fish_id, start, end, duration) with no
+        overlapping runs for the same fish (like get_nan_runs(...).tolist())"""
+        self.starts = {}  # fish_id -> sorted list of starts
+        self.ends = {}  # fish_id -> list of ends aligned with starts
+        self.n = 0
+        for fish_id, start, end, _ in sorted(runs):
+            self.starts.setdefault(fish_id, []).append(start)
+            self.ends.setdefault(fish_id, []).append(end)
+            self.n += 1
+        self.heap = [
+            (start, fish_id, end)
+            for fish_id in self.starts
+            for start, end in zip(self.starts[fish_id], self.ends[fish_id])
+        ]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        """Yields (fish_id, start, end, duration) sorted by start"""
+        for start, fish_id, end in sorted(
+            (start, fish_id, end)
+            for fish_id in self.starts
+            for start, end in zip(self.starts[fish_id], self.ends[fish_id])
+        ):
+            yield fish_id, start, end, end - start
+
+    def __contains__(self, episode):
+        fish_id, start, end = episode[:3]
+        starts = self.starts.get(fish_id, [])
+        i = bisect_left(starts, start)
+        return i < len(starts) and starts[i] == start and self.ends[fish_id][i] == end
+
+    def add(self, fish_id, start, end):
+        """Adds frames [start, end) of a fish as pending, merged with any
+        overlapping or adjacent episode of the same fish"""
+        starts = self.starts.setdefault(fish_id, [])
+        ends = self.ends.setdefault(fish_id, [])
+        i = bisect_left(ends, start)
+        j = bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+        self.n += 1 - (j - i)
+        heapq.heappush(self.heap, (start, fish_id, end))
+
+    def remove(self, fish_id, start, end):
+        """Removes frames [start, end) of a fish from the pending episodes,
+        trimming or splitting the ones partially covered"""
+        starts = self.starts.get(fish_id, [])
+        ends = self.ends.get(fish_id, [])
+        i = bisect_right(ends, start)
+        j = bisect_left(starts, end)
+        if i >= j:
+            return
+        remaining = []
+        if starts[i] < start:
+            remaining.append((starts[i], start))
+        if ends[j - 1] > end:
+            remaining.append((end, ends[j - 1]))
+        starts[i:j] = [s for s, _ in remaining]
+        ends[i:j] = [e for _, e in remaining]
+        self.n += len(remaining) - (j - i)
+        for s, e in remaining:
+            heapq.heappush(self.heap, (s, fish_id, e))
+
+    def peek(self, n=1):
+        """Returns (without removing them) the next n episodes pop would return"""
+        k = n
+        while True:
+            episodes = list(
+                dict.fromkeys(
+                    (fish_id, start, end, end - start)
+                    for start, fish_id, end in heapq.nsmallest(k, self.heap)
+                    if (fish_id, start, end) in self
+                )
+            )
+            if len(episodes) >= n or k >= len(self.heap):
+                return episodes[:n]
+            k *= 2
+
+    def pop(self):
+        """Removes and returns the pending episode with the lowest start frame
+        as (fish_id, start, end, duration)"""
+        while self.heap:
+            start, fish_id, end = heapq.heappop(self.heap)
+            if (fish_id, start, end) in self:  # heap entries can be outdated
+                self.remove(fish_id, start, end)
+                return fish_id, start, end, end - start
+        raise IndexError("pop from an empty episode_index")
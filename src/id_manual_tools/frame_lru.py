@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+class frame_lru:
+    """In-memory least recently used cache of frames (numpy arrays) bounded
+    by their total size in MB instead of by number of entries. Used by the
+    GUI tools to keep the frames around the current one ready to draw.
+    """
+
+    def __init__(self, max_mb=1024):
+        self.max_bytes = max_mb * 2**20
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, key):
+        return key in self.frames
+
+    def __str__(self):
+        return (
+            f"{len(self)} frames, {self.nbytes / 2**20:.0f}/{self.max_bytes / 2**20:.0f} MB, "
+            f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+        )
+
+    def get(self, key, load):
+        """Returns the cached frame for key or load(key), which is cached
+        unless it is None"""
+        try:
+            frame = self.frames[key]
+        except KeyError:
+            self.misses += 1
+            frame = load(key)
+            if frame is not None:
+                self.put(key, frame)
+            return frame
+        self.hits += 1
+        self.frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        if key in self.frames:
+            self.nbytes -= self.frames.pop(key).nbytes
+        if frame.nbytes > self.max_bytes:
+            return
+        self.frames[key] = frame
+        self.nbytes += frame.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.frames.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
@@ -0,0 +1,451 @@
+import os
+import json
+import hashlib
+from shutil import rmtree
+import numpy as np
+import cv2
+from numpy.lib.format import open_memmap
+
+try:
+    import fcntl
+except ImportError:  # Windows, no locking between sessions
+    fcntl = None
+
+
+def lock(file, exclusive=False, blocking=True):
+    """flock on an open file, returns False if not blocking and already locked"""
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(file.fileno(), flags)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def unlock(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class frame_store:
+    """Preloaded (processed) frames stored in a few preallocated uint8 chunk
+    files of chunk_size frames each, with a frame -> slot index.
+
+    The store holds at most capacity frames. Slots are allocated as a ring
+    buffer, so once it is full the oldest allocated frames are dropped.
+
+    Slot allocation and writes are serialized with a lock file, so that a
+    frame is never written into a slot given to another frame (any number of
+    processes can load frames into the store). Reads return views of
+    the memory-mapped chunk (zero-copy). Every open store holds a shared lock
+    on path/in_use.lock so that frame_cache doesn't evict it.
+
+        path/frame_store.json  shape and capacity of the store
+        path/slots.npy         slot of every video frame (-1 if none)
+        path/ready.npy         1 if the frame has been written
+        path/owners.npy        frame of every slot (-1 if none)
+        path/ring.npy          next slot to allocate
+        path/chunk_XXXXX.dat   raw frames
+    """
+
+    def __init__(
+        self, path, n_frames=None, shape=None, chunk_size=1024, capacity=None
+    ):
+        """Opens the store at path. If n_frames, shape and capacity (default
+        n_frames) are given and differ from the stored ones, the store is
+        created from scratch"""
+        self.path = os.path.abspath(path)
+        self.meta_path = os.path.join(self.path, "frame_store.json")
+        self.on_grow = None  # called after creating new chunk files
+        self.acquire()
+
+        if n_frames is not None:
+            meta = {
+                "n_frames": int(n_frames),
+                "shape": [int(s) for s in shape],
+                "chunk_size": int(chunk_size),
+                "capacity": int(max(1, min(capacity or n_frames, n_frames))),
+            }
+            if self.read_meta() != meta:
+                self.recreate(meta)
+
+        meta = self.read_meta()
+        if meta is None:
+            raise FileNotFoundError(f"No frame store found in {self.path}")
+        self.n_frames = meta["n_frames"]
+        self.shape = tuple(meta["shape"])
+        self.chunk_size = meta["chunk_size"]
+        self.capacity = meta["capacity"]
+        self.open()
+
+    def acquire(self):
+        """Takes the shared in_use lock. If frame_cache deleted the store while
+        waiting for it, the lock is taken again on the new lock file"""
+        lock_path = os.path.join(self.path, "in_use.lock")
+        while True:
+            os.makedirs(self.path, exist_ok=True)
+            self.in_use = open(lock_path, "a")
+            lock(self.in_use)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(self.in_use.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.in_use.close()
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def recreate(self, meta):
+        """Creates the store with meta unless another process did it first.
+        An existing store is only replaced if no other session has it open"""
+        with open(os.path.join(self.path, "allocate.lock"), "a") as lock_file:
+            lock(lock_file, exclusive=True)
+            old_meta = self.read_meta()
+            if old_meta != meta:
+                if old_meta is not None and not lock(
+                    self.in_use, exclusive=True, blocking=False
+                ):
+                    unlock(lock_file)
+                    self.in_use.close()
+                    raise RuntimeError(
+                        f"Frame store {self.path} is in use with other parameters"
+                    )
+                self.create(meta)
+                lock(self.in_use)  # back to shared
+            unlock(lock_file)
+
+    def create(self, meta):
+        os.makedirs(self.path, exist_ok=True)
+        self.clear()
+        open_memmap(
+            os.path.join(self.path, "slots.npy"),
+            mode="w+",
+            dtype=np.int64,
+            shape=(meta["n_frames"],),
+        )[:] = -1
+        open_memmap(
+            os.path.join(self.path, "ready.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(meta["n_frames"],),
+        )
+        open_memmap(
+            os.path.join(self.path, "owners.npy"),
+            mode="w+",
+            dtype=np.int64,
+            shape=(meta["capacity"],),
+        )[:] = -1
+        open_memmap(
+            os.path.join(self.path, "ring.npy"), mode="w+", dtype=np.int64, shape=(1,)
+        )
+        with open(self.meta_path, "w") as file:
+            json.dump(meta, file)
+
+    def clear(self):
+        for file in os.listdir(self.path):
+            if file.startswith("chunk_") or file in (
+                "slots.npy",
+                "ready.npy",
+                "owners.npy",
+                "ring.npy",
+                "frame_store.json",
+            ):
+                os.remove(os.path.join(self.path, file))
+
+    def open(self):
+        self.slots = open_memmap(os.path.join(self.path, "slots.npy"), mode="r+")
+        self.ready = open_memmap(os.path.join(self.path, "ready.npy"), mode="r+")
+        self.owners = open_memmap(os.path.join(self.path, "owners.npy"), mode="r+")
+        self.ring = open_memmap(os.path.join(self.path, "ring.npy"), mode="r+")
+        self.chunks = {}
+
+    # memmaps are reopened in the receiving process instead of being pickled
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.path, f"chunk_{chunk:05d}.dat")
+
+    def chunk(self, chunk):
+        if chunk not in self.chunks:
+            self.chunks[chunk] = np.memmap(
+                self.chunk_path(chunk),
+                dtype=np.uint8,
+                mode="r+",
+                shape=(self.chunk_size, *self.shape),
+            )
+        return self.chunks[chunk]
+
+    def allocate(self, frames):
+        """Assigns a slot to every frame in frames that doesn't have one,
+        creating the needed chunk files (sparse). If the store is full, the
+        slots allocated first are reused and their frames dropped. Only the
+        first capacity frames of frames are allocated"""
+        frames = np.asarray(frames, dtype=np.int64)
+        frames = frames[np.sort(np.unique(frames, return_index=True)[1])]
+        if not np.any(self.slots[frames] < 0):
+            return
+
+        created = False
+        with open(os.path.join(self.path, "allocate.lock"), "a") as lock_file:
+            lock(lock_file, exclusive=True)
+            new_frames = frames[self.slots[frames] < 0][: self.capacity]
+            first = int(self.ring[0])
+            new_slots = (first + np.arange(len(new_frames))) % self.capacity
+
+            dropped = self.owners[new_slots]
+            dropped = dropped[dropped >= 0]
+            self.ready[dropped] = 0
+            self.slots[dropped] = -1
+            self.slots[new_frames] = new_slots
+            self.owners[new_slots] = new_frames
+            self.ring[0] = (first + len(new_frames)) % self.capacity
+            for array in (self.ready, self.slots, self.owners, self.ring):
+                array.flush()
+
+            chunk_bytes = self.chunk_size * int(np.prod(self.shape))
+            for chunk in np.unique(new_slots // self.chunk_size).tolist():
+                if not os.path.exists(self.chunk_path(chunk)):
+                    with open(self.chunk_path(chunk), "wb") as file:
+                        file.truncate(chunk_bytes)
+                    created = True
+            unlock(lock_file)
+
+        if created and self.on_grow is not None:
+            self.on_grow()
+
+    def written(self, frames):
+        """Boolean mask, True for the frames written and still in a slot"""
+        frames = np.asarray(frames, dtype=np.int64)
+        return (self.ready[frames] != 0) & (self.slots[frames] >= 0)
+
+    def missing(self, frames):
+        """Frames (from frames) not written yet"""
+        frames = np.asarray(frames, dtype=np.int64)
+        return frames[~self.written(frames)]
+
+    def __contains__(self, frame):
+        return bool(self.written(frame))
+
+    def write(self, frame, image):
+        """Writes the frame in its slot. Holding the allocation lock, so that
+        its slot can't be given to another frame in the meantime. Frames
+        dropped by a later allocation (full store) are ignored"""
+        with open(os.path.join(self.path, "allocate.lock"), "a") as lock_file:
+            lock(lock_file, exclusive=True)
+            slot = int(self.slots[frame])
+            if slot >= 0 and self.owners[slot] == frame:
+                self.chunk(slot // self.chunk_size)[slot % self.chunk_size] = image
+                self.ready[frame] = 1
+            unlock(lock_file)
+
+    def get(self, frame):
+        """Returns a read view of the frame or None if not written yet"""
+        slot = int(self.slots[frame])
+        if not self.ready[frame] or slot < 0:
+            return None
+        return self.chunk(slot // self.chunk_size)[slot % self.chunk_size]
+
+    def close(self):
+        self.chunks = {}
+        unlock(self.in_use)
+        self.in_use.close()
+
+
+def half_shape(shape):
+    return ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+
+
+class frame_pyramid:
+    """The same frames at decreasing resolutions, one frame_store per level
+    (level n is downscaled by 2**n). Same interface as frame_store: written
+    frames are downscaled to every level and a frame is ready once all its
+    levels are written.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.levels = len(stores) - 1
+        self.n_frames = stores[0].n_frames
+        self.shape = stores[0].shape
+        self.capacity = stores[0].capacity
+
+    def allocate(self, frames):
+        for store in self.stores:
+            store.allocate(frames)
+
+    def missing(self, frames):
+        """Frames (from frames) not written in every level. All the levels
+        are checked, any of them can be recreated on its own"""
+        frames = np.asarray(frames, dtype=np.int64)
+        ready = np.ones(len(frames), bool)
+        for store in self.stores:
+            ready &= store.written(frames)
+        return frames[~ready]
+
+    def __contains__(self, frame):
+        return all(frame in store for store in self.stores)
+
+    def write(self, frame, image):
+        for level, store in enumerate(self.stores):
+            if level:
+                height, width = store.shape
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            store.write(frame, image)
+
+    def get(self, frame, level=0):
+        """Returns a read view of the frame at level or None if not written yet"""
+        if frame not in self:
+            return None
+        return self.stores[level].get(frame)
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+
+def video_fingerprint(video_path, sample_bytes=1 << 20):
+    """Identifies a video by its content (size and the first and last MB)
+    so that renamed or moved videos still hit the cache"""
+    size = os.path.getsize(video_path)
+    sha = hashlib.sha1(str(size).encode())
+    with open(video_path, "rb") as file:
+        sha.update(file.read(sample_bytes))
+        file.seek(max(0, size - sample_bytes))
+        sha.update(file.read(sample_bytes))
+    return sha.hexdigest()
+
+
+def disk_usage(path):
+    usage = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            # Chunk files are sparse, count the allocated blocks when possible
+            usage += stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size
+    return usage
+
+
+class frame_cache:
+    """Directory of cache entries keyed by (video fingerprint, crop box,
+    processing parameters), shared by any number of sessions and videos.
+    Every entry is a frame_pyramid (one frame_store per level):
+
+        path/<key>/params.json   description of the entry (its mtime is the
+                                 last time it was opened)
+        path/<key>/level_<n>/    frame_store of level n
+
+    When the total size exceeds max_bytes, the least recently opened entries
+    not in use by any session are deleted as a whole.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        self.remove_legacy()
+
+    def remove_legacy(self):
+        """Deletes the path/<frame>.npz files of the previous preloading format.
+        They can't be converted, they don't record their video nor crop"""
+        legacy = [
+            name
+            for name in os.listdir(self.path)
+            if name.endswith(".npz") and name[:-4].isdigit()
+        ]
+        if legacy:
+            print(f"Removing {len(legacy)} frames of the old format from {self.path}")
+            for name in legacy:
+                os.remove(os.path.join(self.path, name))
+
+    def key(self, video_path, params):
+        description = {"video": video_fingerprint(video_path), "params": params}
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()[:16]
+
+    def open(self, video_path, n_frames, shape, params):
+        """Returns the frame_store for the video processed with params
+        (any JSON-serializable description of crop and processing)"""
+        pyramid = self.open_pyramid(video_path, n_frames, shape, params, levels=0)
+        return pyramid.stores[0]
+
+    def open_pyramid(self, video_path, n_frames, shape, params, levels=2):
+        """Returns a frame_pyramid with levels downscaled levels on top of the
+        full resolution one, stored as a single entry of the cache"""
+        shapes = [shape]
+        for _ in range(levels):
+            shapes.append(half_shape(shapes[-1]))
+        # The whole pyramid fits in max_bytes, older frames are dropped otherwise
+        frame_bytes = sum(int(np.prod(level_shape)) for level_shape in shapes)
+        capacity = max(1, min(int(self.max_bytes // frame_bytes), n_frames))
+
+        # Sessions with another cache size get their own entry instead of
+        # recreating the stores under each other
+        params = dict(params, levels=levels, capacity=capacity)
+        entry = os.path.join(self.path, self.key(video_path, params))
+        if os.path.exists(os.path.join(entry, "params.json")):
+            print(f"Reusing frames from {entry}")
+        else:
+            print(f"Creating new preloaded frames store: {entry}")
+
+        stores = [
+            frame_store(
+                os.path.join(entry, f"level_{level}"),
+                n_frames,
+                level_shape,
+                capacity=capacity,
+            )
+            for level, level_shape in enumerate(shapes)
+        ]
+        # The other entries are evicted as this one grows
+        stores[0].on_grow = self.evict
+        with open(os.path.join(entry, "params.json"), "w") as file:
+            json.dump({"video_path": os.path.abspath(video_path), "params": params}, file)
+        self.evict()
+        return frame_pyramid(stores)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            params_path = os.path.join(self.path, name, "params.json")
+            if os.path.exists(params_path):
+                entries.append((os.path.getmtime(params_path), name))
+
+        usage = {name: disk_usage(os.path.join(self.path, name)) for _, name in entries}
+        total = sum(usage.values())
+        for _, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self.remove(name):
+                total -= usage[name]
+
+    def remove(self, name):
+        """Deletes an entry holding an exclusive lock on each of its stores.
+        Returns False (and keeps it) if any store is in use"""
+        entry = os.path.join(self.path, name)
+        lock_files = []
+        try:
+            for root, _, files in os.walk(entry):
+                if "frame_store.json" in files:
+                    lock_files.append(open(os.path.join(root, "in_use.lock"), "a"))
+                    if not lock(lock_files[-1], exclusive=True, blocking=False):
+                        return False
+            print(f"Removing least recently used frames store {entry}")
+            rmtree(entry, ignore_errors=True)
+            return True
+        finally:
+            for lock_file in lock_files:
+                lock_file.close()
@@ -0,0 +1,170 @@
+from multiprocessing import Pool
+import numpy as np
+from scipy.interpolate import make_interp_spline
+from rich import print
+
+from id_manual_tools.get_nans import get_nan_runs
+from id_manual_tools.trajectory_io import load_trajectory, correction_journal
+from id_manual_tools.utils import EPISODE_PAD, EPISODE_PAD_EXTRA
+
+# Frames around the gap used to fit the interpolator, the same as the GUI
+CONTEXT = EPISODE_PAD + EPISODE_PAD_EXTRA
+
+
+class episode_interpolator:
+    """Cubic interpolator (same as interp1d(kind="cubic", fill_value="extrapolate"))
+    of the (frames x 2) trajectory of one fish, fitted on the valid positions
+    less than context frames away from the episode [start, end).
+
+    The mask of valid samples is kept for the fitting window and only updated
+    where the trajectory changes (see changed). The spline is refitted from
+    it when first evaluated after a change, and the evaluations of the
+    displayed ranges are cached until the next change.
+    """
+
+    def __init__(self, traj):
+        self.traj = traj
+        self.first = self.last = 0  # fitting window [first, last)
+        self.valid = np.zeros(0, bool)
+        self.spline = None
+        self.evaluations = {}
+
+    def set_episode(self, start, end, context=CONTEXT):
+        """Moves the fitting window, only the new frames are checked for nans"""
+        first = max(0, start - context)
+        last = min(len(self.traj), end + context)
+        if (first, last) == (self.first, self.last):
+            return
+        valid = np.empty(last - first, bool)
+        overlap_first = min(max(first, self.first), last)
+        overlap_last = max(min(last, self.last), overlap_first)
+        valid[overlap_first - first : overlap_last - first] = self.valid[
+            overlap_first - self.first : overlap_last - self.first
+        ]
+        valid[: overlap_first - first] = ~np.isnan(self.traj[first:overlap_first, 0])
+        valid[overlap_last - first :] = ~np.isnan(self.traj[overlap_last:last, 0])
+        self.first, self.last, self.valid = first, last, valid
+        self.invalidate()
+
+    def changed(self, start, end=None):
+        """To be called after modifying the trajectory in frames [start, end)"""
+        end = start + 1 if end is None else end
+        start, end = max(start, self.first), min(end, self.last)
+        if start < end:
+            self.valid[start - self.first : end - self.first] = ~np.isnan(
+                self.traj[start:end, 0]
+            )
+            self.invalidate()
+
+    def invalidate(self):
+        self.spline = None
+        self.evaluations = {}
+
+    @property
+    def x(self):
+        """Frames of the samples used in the fit"""
+        return self.first + np.flatnonzero(self.valid)
+
+    @property
+    def y(self):
+        """(2, n) positions of the samples used in the fit"""
+        return self.traj[self.x].T
+
+    def fit(self):
+        if self.spline is None:
+            x = self.x
+            self.spline = make_interp_spline(x, self.traj[x], k=3)
+        return self.spline
+
+    def __call__(self, frames):
+        """Positions at frames, shaped (2, ...) like interp1d(axis=1)"""
+        return np.moveaxis(self.fit()(frames), -1, 0)
+
+    def at_range(self, start, stop, step=1):
+        """Positions at np.arange(start, stop, step), cached until the next change"""
+        key = (start, stop, step)
+        if key not in self.evaluations:
+            self.evaluations[key] = self(np.arange(start, stop, step))
+        return self.evaluations[key]
+
+
+def fit_interpolator(traj, start, end, context=CONTEXT):
+    """Cubic interpolator of the (frames x 2) trajectory of one fish fitted on
+    the valid positions less than context frames away from [start, end)"""
+    interpolator = episode_interpolator(traj)
+    interpolator.set_episode(start, end, context)
+    interpolator.fit()
+    return interpolator
+
+
+def fill_fish_gaps(traj, runs, context=CONTEXT):
+    """Fills the gaps [start, end) of runs (sorted by start) of a single fish
+    in order, so that every fit sees the gaps filled before it, like the GUI
+    does. Returns the filled trajectory and a boolean mask of filled runs"""
+    traj = np.array(traj)
+    filled = np.zeros(len(runs), bool)
+    for i, (start, end) in enumerate(runs):
+        try:
+            interpolator = fit_interpolator(traj, start, end, context)
+        except ValueError:  # not enough valid points around the gap
+            continue
+        traj[start:end] = interpolator(np.arange(start, end)).T
+        filled[i] = True
+    return traj, filled
+
+
+def _fill_fish_gaps(args):
+    return fill_fish_gaps(*args)
+
+
+def fill_gaps(trajectories, max_length, context=CONTEXT, n_cores=4):
+    """Fills (in place) every gap of nans of up to max_length frames with
+    the cubic interpolator used by the GUI, in parallel over fish.
+
+    Returns the filled runs as a NAN_RUN_DTYPE array sorted by fish and start
+    """
+    runs = get_nan_runs(trajectories, sort_by=None)  # by fish, then start
+    runs = runs[runs["duration"] <= max_length]
+    if not len(runs):
+        return runs
+
+    fish_ids, first = np.unique(runs["fish_id"], return_index=True)
+    runs_per_fish = np.split(runs, first[1:])
+    jobs = [
+        (
+            trajectories[:, fish_id],
+            np.column_stack((fish_runs["start"], fish_runs["end"])),
+            context,
+        )
+        for fish_id, fish_runs in zip(fish_ids, runs_per_fish)
+    ]
+    with Pool(n_cores) as pool:
+        results = pool.map(_fill_fish_gaps, jobs)
+
+    filled = []
+    for fish_id, (traj, fish_filled) in zip(fish_ids, results):
+        trajectories[:, fish_id] = traj
+        filled.append(fish_filled)
+    return runs[np.concatenate(filled)]
+
+
+def fill_session_gaps(traj_path, max_length, n_cores=4):
+    """Fills the short gaps of a trajectory file and writes them to its
+    correction journal (see trajectory_io), without any GUI"""
+    data = load_trajectory(traj_path, mmap_mode="c")
+    trajectories = data["trajectories"]
+    print(f"Filling gaps up to {max_length} frames in {traj_path}")
+
+    n_gaps = len(get_nan_runs(trajectories, sort_by=None))
+    filled = fill_gaps(trajectories, max_length, n_cores=n_cores)
+
+    journal = correction_journal(traj_path)
+    for fish_id, start, end, _ in filled.tolist():
+        journal.append_positions(fish_id, start, trajectories[start:end, fish_id])
+    journal.sync()
+
+    print(
+        f"Filled {len(filled)} gaps ({filled['duration'].sum()} frames), "
+        f"{n_gaps - len(filled)} gaps left for the GUI"
+    )
+    return filled
@@ -0,0 +1,183 @@
+import numpy as np
+from id_manual_tools.utils import trajectory_path
+from id_manual_tools.trajectory_io import load_trajectory
+from id_manual_tools.get_nans import get_runs_from_mask, sort_runs, NAN_RUN_DTYPE
+import os
+from argparse import ArgumentParser
+
+# Standard deviation of a normal distribution in MAD units
+MAD_TO_STD = 1.4826
+
+
+def iter_speeds(traj, chunk_size=100_000):
+    """Yields the (rows, fish) float32 displacement between consecutive frames
+    of a (frames, fish, 2) trajectory, chunk_size rows at a time. The
+    trajectory (can be a memmap) is read one chunk at a time"""
+    n_frames = len(traj)
+    for start in range(0, n_frames - 1, chunk_size):
+        end = min(n_frames, start + chunk_size + 1)
+        step = np.diff(np.asarray(traj[start:end], dtype=np.float64), axis=0)
+        yield np.sqrt(np.einsum("ijk,ijk->ij", step, step)).astype(np.float32)
+
+
+def select_ranks(chunks, ranks, bits=(11, 11, 10)):
+    """Exact per column order statistics of non negative float32 values.
+
+    chunks() returns a new iterator of (rows, columns) float32 arrays (NaNs are
+    ignored) and ranks is a (queries, columns) array of 0-based ranks. Non
+    negative floats sort as their bit patterns, so the values are found a few
+    bits at a time (radix select), one pass over chunks() per item of bits.
+    Memory doesn't depend on the number of rows. Returns (queries, columns)
+    float32
+    """
+    ranks = np.array(ranks, dtype=np.int64)
+    n_queries, n_columns = ranks.shape
+    prefix = np.zeros(ranks.shape, np.uint32)
+    shift = 32
+    for n_bits in bits:
+        shift -= n_bits
+        n_bins = 1 << n_bits
+        counts = np.zeros((n_queries, n_columns * n_bins), np.int64)
+        for chunk in chunks():
+            chunk = np.ascontiguousarray(chunk, dtype=np.float32)
+            keys = chunk.view(np.uint32)
+            valid = ~np.isnan(chunk)
+            digits = (keys >> shift) & (n_bins - 1)
+            for query in range(n_queries):
+                if query and np.array_equal(prefix[query], prefix[query - 1]):
+                    counts[query] = counts[query - 1]  # same values, same counts
+                    continue
+                if shift + n_bits < 32:  # only values with the prefix found so far
+                    match = valid & (
+                        keys >> (shift + n_bits) == prefix[query] >> (shift + n_bits)
+                    )
+                else:
+                    match = valid
+                column = np.nonzero(match)[1]
+                counts[query] += np.bincount(
+                    column * n_bins + digits[match], minlength=n_columns * n_bins
+                )
+        counts = counts.reshape(n_queries, n_columns, n_bins)
+        cumulative = np.cumsum(counts, axis=2)
+        digit = np.minimum((cumulative <= ranks[..., None]).sum(axis=2), n_bins - 1)
+        below = np.take_along_axis(cumulative - counts, digit[..., None], axis=2)
+        ranks -= below[..., 0]
+        prefix |= digit.astype(np.uint32) << shift
+    return prefix.view(np.float32)
+
+
+def get_jump_thresholds(traj, sigma, chunk_size=100_000):
+    """Per fish speed threshold median + sigma * (MAD in std units). Fish with
+    a null MAD (mostly still) use their standard deviation instead.
+
+    The statistics are exact but computed in a few passes over the trajectory
+    (see select_ranks), so memory doesn't grow with the video length"""
+    n_fish = traj.shape[1]
+    count = np.zeros(n_fish, np.int64)
+    total = np.zeros(n_fish)
+    for speeds in iter_speeds(traj, chunk_size):
+        count += np.sum(~np.isnan(speeds), axis=0)
+        total += np.nansum(speeds, axis=0)
+    empty = count == 0  # fish without any valid speed
+
+    def middle(chunks):
+        low, high = select_ranks(chunks, [(count - 1) // 2, count // 2])
+        value = ((low.astype(np.float64) + high) / 2).astype(np.float32)
+        value[empty] = np.nan
+        return value
+
+    median = middle(lambda: iter_speeds(traj, chunk_size))
+    scale = MAD_TO_STD * middle(
+        lambda: (np.abs(speeds - median) for speeds in iter_speeds(traj, chunk_size))
+    )
+    still = ~(scale > 0) & ~empty
+    if np.any(still):
+        mean = total[still] / count[still]
+        squares = np.zeros(len(mean))
+        for speeds in iter_speeds(traj, chunk_size):
+            squares += np.nansum((speeds[:, still] - mean) ** 2, axis=0)
+        scale[still] = np.sqrt(squares / count[still])
+    return median + sigma * scale
+
+
+def get_jump_runs(traj, sigma, chunk_size=100_000, sort_by="length"):
+    """Structured array (NAN_RUN_DTYPE) of runs of impossible jumps:
+
+        (fish_id, start, end, duration)
+
+    where the displacement from frame t to t+1 of fish_id is over its own
+    threshold (see get_jump_thresholds) for every t in [start, end). Runs are
+    found chunk by chunk and joined across chunk boundaries
+    """
+    thresholds = get_jump_thresholds(traj, sigma, chunk_size)
+    runs = []
+    for start, speeds in zip(
+        range(0, len(traj), chunk_size), iter_speeds(traj, chunk_size)
+    ):
+        chunk_runs = get_runs_from_mask(speeds > thresholds, sort_by=None)
+        chunk_runs["start"] += start
+        chunk_runs["end"] += start
+        runs.append(chunk_runs)
+    runs = np.concatenate(runs) if runs else np.empty(0, NAN_RUN_DTYPE)
+    if not len(runs):  # no jumps at all
+        return runs
+
+    # A run touching the end of a chunk continues in the next one
+    runs = runs[np.lexsort((runs["start"], runs["fish_id"]))]
+    continued = np.zeros(len(runs), bool)
+    continued[1:] = (runs["fish_id"][1:] == runs["fish_id"][:-1]) & (
+        runs["start"][1:] == runs["end"][:-1]
+    )
+    first = np.nonzero(~continued)[0]
+    last = np.append(first[1:], len(runs)) - 1
+    joined = runs[first]
+    joined["end"] = runs["end"][last]
+    joined["duration"] = joined["end"] - joined["start"]
+    return sort_runs(joined, sort_by)
+
+
+def main():
+    parser = ArgumentParser(
+        description="Impossible jumps observation in idtrackeri.ai trajectories."
+    )
+    parser.add_argument(
+        "s",
+        metavar="session",
+        help="idTracker.ai successful session directory or trajectory file",
+    )
+    parser.add_argument(
+        "-sigma",
+        type=float,
+        default=6,
+        help="Jumps are displacements over median + sigma * MAD (in std units) of each fish. Default is 6",
+    )
+    parser.add_argument(
+        "-o", type=str, help="output file, default input[:4]+'_jumps.csv'"
+    )
+    args = parser.parse_args()
+
+    input_path = trajectory_path(args.s, read_only=True)
+
+    output_path = (
+        os.path.abspath(args.o)
+        if args.o
+        else os.path.splitext(input_path)[0] + "_jumps.csv"
+    )
+
+    traj = load_trajectory(input_path, mmap_mode="r")["trajectories"]
+
+    jumps = get_jump_runs(traj, args.sigma)
+
+    np.savetxt(
+        output_path,
+        jumps.view((np.int64, 4)),
+        fmt="%d",
+        delimiter=",",
+        header="fish_id,start,end,duration",
+        comments="",
+    )
+    print(f"File saved at {output_path}")
+
+
+if __name__ == "__main__":
+    main()
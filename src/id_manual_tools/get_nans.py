@@ -1,6 +1,6 @@
 import numpy as np
-import csv
 from id_manual_tools.utils import trajectory_path
+from id_manual_tools.trajectory_io import load_trajectory
 import os
 from argparse import ArgumentParser
 
@@ -26,6 +26,62 @@ def find_nans_1D(data, id=None):
         return [(e - n, e, n) for e, n in zip(end[valid], nan[valid])]
 
 
+NAN_RUN_DTYPE = np.dtype(
+    [("fish_id", np.int64), ("start", np.int64), ("end", np.int64), ("duration", np.int64)]
+)
+
+
+def get_runs_from_mask(mask, sort_by="length"):
+    """Returns a structured array (NAN_RUN_DTYPE) with every run of True values
+    of a (frames x fish) boolean mask, found in a single vectorized pass:
+
+        (fish_id, start, end, duration)
+
+    In such a way that mask[start, fish_id] is the first True and
+    mask[end-1, fish_id] is the last one.
+    Runs are sorted by sort_by ("length", "end", "start" or "id", reverse),
+    ties are left ordered by fish_id and start.
+    """
+    if mask.ndim == 1:
+        mask = mask[:, None]
+
+    padded = np.zeros((mask.shape[1], mask.shape[0] + 2), np.int8)
+    padded[:, 1:-1] = mask.T
+    edges = np.diff(padded, axis=1)
+    fish_id, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[1]
+
+    runs = np.empty(len(start), NAN_RUN_DTYPE)
+    runs["fish_id"] = fish_id
+    runs["start"] = start
+    runs["end"] = end
+    runs["duration"] = end - start
+    return sort_runs(runs, sort_by)
+
+
+def sort_runs(runs, sort_by="length"):
+    """Sorts runs (NAN_RUN_DTYPE) by sort_by ("length", "end", "start" or "id",
+    reverse), ties are left ordered by fish_id and start. Any other sort_by
+    returns them untouched"""
+    sort_keys = {
+        "length": (runs["start"], runs["fish_id"], -runs["duration"]),
+        "end": (runs["fish_id"], -runs["end"]),
+        "start": (runs["fish_id"], -runs["start"]),
+        "id": (runs["start"], -runs["fish_id"]),
+    }
+    if sort_by in sort_keys:
+        runs = runs[np.lexsort(sort_keys[sort_by])]
+    return runs
+
+
+def get_nan_runs(traj, sort_by="length"):
+    """Structured array of nan runs of a trajectory 1D/2D/3D array,
+    see get_runs_from_mask"""
+    if traj.ndim == 3:
+        traj = traj[..., 0]
+    return get_runs_from_mask(np.isnan(traj), sort_by=sort_by)
+
+
 def get_list_of_nans_from_traj(traj, sort_by="length"):
     """Returns a list of the nans location for a trajectory 2D/3D array:
 
@@ -35,25 +91,10 @@ def get_list_of_nans_from_traj(traj, sort_by="length"):
     traj[fish_id, end-1] is the last nan.
     Elements in the list are sorted by length of slice (reverse)
     """
-    if traj.ndim == 3:
-        traj = traj[..., 0]
-
+    nans = get_nan_runs(traj, sort_by=sort_by)
     if traj.ndim == 1:
-        nans = find_nans_1D(traj)
-    else:
-        nans = []
-        for fish_id in range(traj.shape[1]):
-            nans += find_nans_1D(traj[:, fish_id], fish_id)
-
-    if sort_by == "length":
-        nans.sort(key=lambda x: x[-1], reverse=True)
-    elif sort_by == "end":
-        nans.sort(key=lambda x: x[-2], reverse=True)
-    elif sort_by == "start":
-        nans.sort(key=lambda x: x[-3], reverse=True)
-    elif sort_by == "id":
-        nans.sort(key=lambda x: x[-4], reverse=True)
-    return nans
+        return nans[["start", "end", "duration"]].tolist()
+    return nans.tolist()
 
 
 def main():
@@ -72,16 +113,24 @@ def main():
 
     input_path = trajectory_path(args.s, read_only=True)
 
-    output_path = os.path.abspath(args.o) if args.o else input_path[:-4] + "_nans.csv"
+    output_path = (
+        os.path.abspath(args.o)
+        if args.o
+        else os.path.splitext(input_path)[0] + "_nans.csv"
+    )
 
-    traj = np.load(input_path, allow_pickle=True).item()["trajectories"][..., 0]
+    traj = load_trajectory(input_path, mmap_mode="r")["trajectories"][..., 0]
 
-    nans = get_list_of_nans_from_traj(traj)
+    nans = get_nan_runs(traj)
 
-    with open(output_path, "w", newline="") as csvfile:
-        csvfile.write("fish_id,start,end,duration\n")
-        writer = csv.writer(csvfile)
-        writer.writerows(nans)
+    np.savetxt(
+        output_path,
+        nans.view((np.int64, 4)),
+        fmt="%d",
+        delimiter=",",
+        header="fish_id,start,end,duration",
+        comments="",
+    )
     print(f"File saved at {output_path}")
 
 
@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+SWAP_RUN_DTYPE = np.dtype(
+    [
+        ("fish_id", np.int64),
+        ("other_id", np.int64),
+        ("start", np.int64),
+        ("end", np.int64),
+        ("duration", np.int64),
+    ]
+)
+
+
+def get_close_pairs(traj, radius, chunk_size=5000):
+    """(n, 3) int64 array of (frame, fish_a, fish_b) with fish_a < fish_b for
+    every pair of fish closer than radius in a (frames, fish, 2) trajectory.
+
+    Frames are processed in chunks of chunk_size (the trajectory can be a
+    memmap) with one cKDTree per chunk. Frames are stacked along a third
+    axis 2 * radius apart so that only pairs from the same frame are found.
+    Memory stays bounded by the chunk instead of frames x fish x fish.
+    """
+    pairs = [np.empty((0, 3), np.int64)]
+    for start in range(0, len(traj), chunk_size):
+        chunk = np.asarray(traj[start : start + chunk_size], dtype=np.float64)
+        frame, fish = np.nonzero(~np.isnan(chunk[..., 0]))
+        if len(frame) < 2:
+            continue
+        points = np.column_stack((chunk[frame, fish], frame * 2.0 * radius))
+        i, j = cKDTree(points).query_pairs(radius, output_type="ndarray").T
+        # points are sorted by frame and fish, so i < j means fish[i] < fish[j]
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        pairs.append(np.column_stack((start + frame[i], fish[i], fish[j])))
+    return np.concatenate(pairs)
+
+
+def get_swap_runs(traj, radius, chunk_size=5000):
+    """Structured array (SWAP_RUN_DTYPE) of close approaches:
+
+        (fish_id, other_id, start, end, duration)
+
+    where fish_id and other_id are closer than radius in every frame of
+    [start, end). Those are the candidates for identity swaps. Runs are
+    sorted by duration (reverse)
+    """
+    pairs = get_close_pairs(traj, radius, chunk_size)
+    if not len(pairs):  # no close approaches at all
+        return np.empty(0, SWAP_RUN_DTYPE)
+    pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 2], pairs[:, 1]))]
+
+    new_run = np.ones(len(pairs), bool)
+    new_run[1:] = np.any(pairs[1:, 1:] != pairs[:-1, 1:], axis=1) | (
+        pairs[1:, 0] != pairs[:-1, 0] + 1
+    )
+    first = np.flatnonzero(new_run)
+    last = np.append(first[1:], len(pairs)) - 1
+
+    runs = np.empty(len(first), SWAP_RUN_DTYPE)
+    runs["fish_id"] = pairs[first, 1]
+    runs["other_id"] = pairs[first, 2]
+    runs["start"] = pairs[first, 0]
+    runs["end"] = pairs[last, 0] + 1
+    runs["duration"] = runs["end"] - runs["start"]
+    return runs[np.argsort(-runs["duration"], kind="stable")]
@@ -0,0 +1,99 @@
+import os
+from subprocess import run, CalledProcessError
+import numpy as np
+import cv2
+from id_manual_tools.frame_store import video_fingerprint
+
+
+def find_keyframes(video_path):
+    """Returns the (sorted) frame numbers of the keyframes of the video.
+
+    It reads the packets of the video stream with ffprobe (nothing is
+    decoded). The n-th smallest pts is frame n, as counted by OpenCV. That
+    only holds if the packets match the frames OpenCV counts and the stream
+    starts at its first packet (edit lists, negative initial pts or dropped
+    frames break it), otherwise an empty array is returned (the index can't
+    be trusted). Returns None if ffprobe is not available.
+    """
+    try:
+        output = run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "packet=pts,flags:stream=start_pts",
+                "-of",
+                "compact=p=0",
+                video_path,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (FileNotFoundError, CalledProcessError) as error:
+        print(f"No keyframe index ({error}), seeking with OpenCV")
+        return None
+
+    pts = []
+    is_key = []
+    start_pts = None
+    for line in output.splitlines():
+        fields = dict(field.split("=", 1) for field in line.split("|") if "=" in field)
+        if "start_pts" in fields:  # stream section
+            try:
+                start_pts = int(fields["start_pts"])
+            except ValueError:  # N/A
+                pass
+            continue
+        try:
+            pts.append(int(fields["pts"]))
+        except (KeyError, ValueError):  # packets without pts (N/A)
+            continue
+        is_key.append("K" in fields.get("flags", ""))
+
+    cap = cv2.VideoCapture(video_path)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    problem = None
+    if not pts or len(pts) != n_frames:
+        problem = f"{len(pts)} packets but OpenCV counts {n_frames} frames"
+    elif len(set(pts)) != len(pts):
+        problem = "repeated packet timestamps"
+    elif start_pts is not None and (start_pts < 0 or min(pts) != start_pts):
+        problem = f"stream starts at pts {start_pts}, first packet at {min(pts)}"
+    if problem is not None:
+        print(f"No keyframe index ({problem}), seeking with OpenCV")
+        return np.zeros(0, dtype=np.int64)
+
+    is_key = np.array(is_key, dtype=bool)[np.argsort(pts, kind="stable")]
+    keyframes = np.nonzero(is_key)[0]
+    if not len(keyframes) or keyframes[0] != 0:
+        keyframes = np.concatenate(([0], keyframes))
+    return keyframes
+
+
+def keyframe_index(video_path, cache_dir):
+    """Keyframes of the video, computed once and cached in
+    cache_dir/keyframes.npz (recomputed if the video changes). None if
+    there's no usable index (see find_keyframes)"""
+    path = os.path.join(cache_dir, "keyframes.npz")
+    fingerprint = video_fingerprint(video_path)
+    try:
+        with np.load(path) as cached:
+            if str(cached["fingerprint"]) == fingerprint:
+                return cached["keyframes"] if len(cached["keyframes"]) else None
+    except (OSError, KeyError, ValueError):
+        pass
+
+    keyframes = find_keyframes(video_path)
+    if keyframes is not None:
+        try:
+            np.savez(path, fingerprint=fingerprint, keyframes=keyframes)
+            if len(keyframes):
+                print(f"Keyframe index ({len(keyframes)} keyframes) saved at {path}")
+        except OSError:
+            pass
+    return keyframes if keyframes is not None and len(keyframes) else None
@@ -1,3 +1,4 @@
+from time import monotonic
 import matplotlib.pyplot as plt
 
 
@@ -8,7 +9,57 @@ class matplotlib_gui:
         self.fig.canvas.draw()
         self.fig.canvas.flush_events()
 
-    def __init__(self, title=" "):
+    def add_animated(self, *artists):
+        """Registers artists redrawn by blit_and_flush, they are left out of
+        the cached background"""
+        for artist in artists:
+            artist.set_animated(True)
+            self.animated_artists.append(artist)
+        self.animated_artists.sort(key=lambda artist: artist.get_zorder())
+
+    def blit_and_flush(self):
+        """Redraws only the animated artists over the cached background. Falls
+        back to a full draw if there's no valid background"""
+        canvas = self.fig.canvas
+        if self.background is None or not canvas.supports_blit:
+            self.draw_and_flush()
+            return
+        canvas.restore_region(self.background)
+        self.draw_animated()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def draw_animated(self):
+        for artist in self.animated_artists:
+            self.fig.draw_artist(artist)
+
+    def schedule_draw(self):
+        """Full redraw as soon as max_fps allows it. Any number of calls
+        before that (pan, zoom...) are coalesced into a single draw"""
+        if self.draw_pending:
+            return
+        self.draw_pending = True
+        wait = self.last_draw + 1 / self.max_fps - monotonic()
+        self.draw_timer.interval = max(1, int(1000 * wait))
+        self.draw_timer.start()
+
+    def on_draw_timer(self):
+        if self.draw_pending:
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
+
+    def on_draw(self, event):
+        """Every full draw refreshes the cached background (and satisfies
+        any scheduled draw)"""
+        self.last_draw = monotonic()
+        if self.draw_pending:
+            self.draw_pending = False
+            self.draw_timer.stop()
+        if self.fig.canvas.supports_blit:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def __init__(self, title=" ", max_fps=30):
 
         self.zoom = 1
         self.Ly = 500  # px
@@ -18,6 +69,11 @@ class matplotlib_gui:
         self.mouse_pressed = False
         self.has_moved = False
         self.Delta = 1
+        self.animated_artists = []
+        self.background = None
+        self.max_fps = max_fps
+        self.last_draw = 0
+        self.draw_pending = False
 
         self.fig = plt.figure(figsize=(8, 8))
         self.ax = self.fig.add_axes(
@@ -37,6 +93,11 @@ class matplotlib_gui:
         self.fig.canvas.mpl_connect("scroll_event", self.on_scroll)
         self.fig.canvas.mpl_connect("motion_notify_event", self.on_motion)
         self.fig.canvas.mpl_connect("resize_event", self.on_resize)
+        self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+
+        self.draw_timer = self.fig.canvas.new_timer()
+        self.draw_timer.single_shot = True
+        self.draw_timer.add_callback(self.on_draw_timer)
 
     def on_click(self, event):
         self.has_moved = False
@@ -65,7 +126,8 @@ class matplotlib_gui:
         self.x_center += (self.x_center - event.xdata) * 0.1 * event.step
         self.y_center += (self.y_center - event.ydata) * 0.1 * event.step
         self.zoom += 0.1 * self.zoom * event.step
-        self.set_ax_lims()
+        self.set_ax_lims(draw=False)
+        self.schedule_draw()
 
     def on_motion(self, event):
         if self.mouse_pressed:
@@ -85,13 +147,15 @@ class matplotlib_gui:
                 / self.canvas_size[1]
             )
             self.click_origin = (event.x, event.y)
-            self.set_ax_lims()
+            self.set_ax_lims(draw=False)
+            self.schedule_draw()
 
     def on_resize(self, event):
         self.Ly = event.height * self.Ly / self.canvas_size[1]
         self.Lx = event.width * self.Lx / self.canvas_size[0]
         self.canvas_size = (event.width, event.height)
-        self.set_ax_lims()
+        self.set_ax_lims(draw=False)
+        self.schedule_draw()
 
     def set_ax_lims(self, draw=True):
         self.ax.set(
@@ -106,3 +170,5 @@ class matplotlib_gui:
         )
         if draw:
             self.fig.canvas.draw()
+        else:
+            self.background = None  # limits changed, next blit draws everything
@@ -1,20 +1,25 @@
-from matplotlib.pyplot import Figure
+from matplotlib.figure import Figure
 import numpy as np
 import cv2
-from matplotlib.animation import FuncAnimation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scipy.signal import savgol_filter
 from matplotlib.collections import LineCollection
 from matplotlib.cm import get_cmap
 from argparse import ArgumentParser
-from tqdm import trange
+from tqdm import tqdm
 from multiprocessing import Pool
-from subprocess import call
-from os import makedirs, remove
-from os.path import splitext
+from subprocess import call, Popen, PIPE
+import json
+from os import makedirs, walk, stat, remove
+from os.path import splitext, dirname, exists, join, abspath, isfile
 from shutil import rmtree
 from warnings import catch_warnings, simplefilter
 from scipy.ndimage import gaussian_filter1d
 from id_manual_tools.utils import trajectory_path, file_path
+from id_manual_tools.trajectory_io import load_trajectory, split_path, journal_path
+from id_manual_tools.keyframes import keyframe_index
+from id_manual_tools.frame_store import video_fingerprint
+from id_manual_tools.preloader import sequential_reader
 
 
 def interpolate_nans(arr):
@@ -22,84 +27,164 @@ def interpolate_nans(arr):
     arr[isnan] = np.interp(np.where(isnan)[0], xp=np.where(~isnan)[0], fp=arr[~isnan])
 
 
-cmap = get_cmap("gist_rainbow")
-
-
-# INPUT ARGUMENTS (ARGPARSER)
-parser = ArgumentParser(
-    description="Renders a composed video with the trajectories overlapping the original video. It uses matplotlib with multiprocessing."
-)
-
-parser.add_argument(
-    "s",
-    metavar="session",
-    type=str,
-    help="idTracker.ai successful session directory or trajectory file",
-)
-parser.add_argument(
-    "video",
-    type=file_path,
-    help="Video file (only one file)",
-)
-
-parser.add_argument(
-    "-o",
-    metavar="output",
-    type=str,
-    help="Output file name, default is (video path)_tracked.mp4",
-)
-parser.add_argument(
-    "-t",
-    metavar="time",
-    type=float,
-    help="Duration of the tracked video (in seconds), default is entire video",
-)
-parser.add_argument(
-    "-z",
-    action="store_true",
-    default=False,
-    help="Activates dynamic zoom in the video",
-)
-
-parser.add_argument(
-    "-vmin",
-    default=0,
-    help="Minimum value for video colormap, default 0",
-)
-
-parser.add_argument(
-    "-vmax",
-    default=255,
-    help="Maximum value for video colormap, default 255",
-)
-parser.add_argument("-n", type=int, default=4, help="number of threads. Default is 4")
-
-args = parser.parse_args()
-line_lenght = 20
-tmp_folder = "tmp_plot_trajectories/"
-
+def view_transform(x0, x1, y0, y1, width, height):
+    """(scale, offset_x, offset_y) that maps the video region [x0, x1] x [y0, y1]
+    into a (width, height) image keeping the aspect ratio (centered, like
+    imshow with equal aspect). Output pixel = video pixel * scale + offset"""
+    scale = min(width / (x1 - x0), height / (y1 - y0))
+    return (
+        scale,
+        0.5 * (width - scale * (x1 - x0)) - scale * x0,
+        0.5 * (height - scale * (y1 - y0)) - scale * y0,
+    )
 
-# LOADING DATA (POSITIONS AND VIDEO)
-data = np.load(trajectory_path(args.s, read_only=True), allow_pickle=True).item()
-pos = data["trajectories"]
-n_frames, N, _ = pos.shape
 
-cap = cv2.VideoCapture(args.video)
-fps = cap.get(cv2.CAP_PROP_FPS)
-nx = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-ny = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-cap.release
-cap = None
+def gray_lut(vmin, vmax):
+    """uint8 lookup table from the sum of the BGR channels (0..765) to the
+    gray level of imshow(cmap="gray", vmin=vmin, vmax=vmax)"""
+    level = 256 * np.clip((np.arange(766) / 3 - vmin) / (vmax - vmin), 0, 1)
+    return np.uint8(np.minimum(level, 255))
+
+
+def visible_region(transform, width, height, nx, ny):
+    """Region (x0, x1, y0, y1) of the source pixels of a (ny, nx) video frame
+    that fall inside a (width, height) output, and the output region
+    (x0, x1, y0, y1) they cover"""
+    scale, offset_x, offset_y = transform
+    # Source pixels (centered at integer coordinates) inside the output
+    x0 = int(np.clip(np.floor(-offset_x / scale + 0.5), 0, nx))
+    x1 = int(np.clip(np.ceil((width - offset_x) / scale + 0.5), 0, nx))
+    y0 = int(np.clip(np.floor(-offset_y / scale + 0.5), 0, ny))
+    y1 = int(np.clip(np.ceil((height - offset_y) / scale + 0.5), 0, ny))
+
+    dst_x0 = int(np.clip(round((x0 - 0.5) * scale + offset_x), 0, width))
+    dst_x1 = int(np.clip(round((x1 - 0.5) * scale + offset_x), 0, width))
+    dst_y0 = int(np.clip(round((y0 - 0.5) * scale + offset_y), 0, height))
+    dst_y1 = int(np.clip(round((y1 - 0.5) * scale + offset_y), 0, height))
+    return (x0, x1, y0, y1), (dst_x0, dst_x1, dst_y0, dst_y1)
+
+
+def prepare_frame(image, region, lut, size=None):
+    """uint8 gray image of the region (x0, x1, y0, y1) of a BGR video frame.
+    The frame is cropped before converting it (sum of the channels in uint16
+    and lut) and, with size=(width, height), resized with INTER_AREA"""
+    x0, x1, y0, y1 = region
+    crop = image[y0:y1, x0:x1]
+    gray = crop[..., 0].astype(np.uint16)
+    gray += crop[..., 1]
+    gray += crop[..., 2]
+    gray = lut[gray]
+    if size is not None and tuple(size) != (x1 - x0, y1 - y0):
+        gray = cv2.resize(gray, tuple(size), interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def rasterize_background(image, transform, width, height, lut):
+    """Gray (BGR) image of a video frame mapped into the output with the exact
+    transform (the same as the trajectories). Only the visible region is
+    converted. Upscaled pixels are kept sharp (nearest, like imshow), a
+    downscaled region is first resized with INTER_AREA to its output size"""
+    scale, offset_x, offset_y = transform
+    ny, nx = image.shape[:2]
+    region, output = visible_region(transform, width, height, nx, ny)
+    x0, x1, y0, y1 = region
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((height, width, 3), np.uint8)
+
+    size = None
+    interpolation = cv2.INTER_NEAREST
+    if scale < 1:
+        size = (max(1, output[1] - output[0]), max(1, output[3] - output[2]))
+        interpolation = cv2.INTER_LINEAR
+    gray = prepare_frame(image, region, lut, size)
+
+    # Pixel k of gray is centered at x0 - 0.5 + (k + 0.5) * step in the video,
+    # output pixels are centered at video * scale + offset - 0.5 (cv2)
+    step_x = (x1 - x0) / gray.shape[1]
+    step_y = (y1 - y0) / gray.shape[0]
+    matrix = np.array(
+        [
+            [step_x * scale, 0, (x0 - 0.5 + 0.5 * step_x) * scale + offset_x - 0.5],
+            [0, step_y * scale, (y0 - 0.5 + 0.5 * step_y) * scale + offset_y - 0.5],
+        ]
+    )
+    canvas = cv2.warpAffine(
+        gray, matrix, (width, height), flags=interpolation, borderValue=0
+    )
+    return cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+
+
+def blend_trails(canvas, points, segments, colors, line_width):
+    """Alpha blends in place the segments (k, fish) from points[k, fish] to
+    points[k + 1, fish] (cv2 coordinates with shift 4) with alpha k / line_lenght"""
+    overlay = np.zeros_like(canvas)
+    alpha = np.zeros(canvas.shape[:2], np.float32)
+    alphas = np.linspace(0, 1, line_lenght)
+    for k, fish in zip(*np.nonzero(segments)):
+        p, q = tuple(points[k, fish]), tuple(points[k + 1, fish])
+        cv2.line(overlay, p, q, colors[fish], line_width + 1, cv2.LINE_8, 4)
+        cv2.line(alpha, p, q, float(alphas[k]), line_width, cv2.LINE_AA, 4)
+    canvas[:] = cv2.blendLinear(overlay, canvas, alpha, 1 - alpha)
+
+
+def rasterize_trajectories(canvas, trail, colors, transform, line_width, radius):
+    """Draws on canvas the fading trails (trail is (n, N, 2), oldest first,
+    with alpha from 0 to 1 along line_lenght frames) and the last positions"""
+    scale, offset_x, offset_y = transform
+    # cv2 coordinates (pixel centers at integers) in 1/16 pixel units
+    points = (trail * scale + (offset_x - 0.5, offset_y - 0.5)) * 16
+    valid = np.all(np.isfinite(points), axis=-1)
+    points = np.where(valid[..., None], points, 0).astype(np.int32)
+
+    # Trails are blended only in their bounding box
+    segments = valid[:-1] & valid[1:]
+    if np.any(segments):
+        pad = line_width + 2
+        x0, y0 = np.maximum(points[valid].min(axis=0) // 16 - pad, 0)
+        x1, y1 = points[valid].max(axis=0) // 16 + pad
+        box = canvas[y0:y1, x0:x1]
+        if box.size:
+            blend_trails(
+                box, points - 16 * np.array((x0, y0)), segments, colors, line_width
+            )
 
+    for fish in np.flatnonzero(valid[-1]):
+        cv2.circle(
+            canvas,
+            tuple(points[-1, fish]),
+            round(16 * radius),
+            colors[fish],
+            -1,
+            cv2.LINE_AA,
+            4,
+        )
+    return canvas
 
-corners = data["setup_points"]["corners_out"]
-xmin = int(np.min(corners[:, 0]))
-xmax = int(np.max(corners[:, 0]))
-ymin = int(np.min(corners[:, 1]))
-ymax = int(np.max(corners[:, 1]))
 
-#  COMPUTING DYNAMIC ZOOM (CENTER OF MASS AND ZOOM RADI)
-if args.z:
+cmap = get_cmap("gist_rainbow")
+line_lenght = 20
+PIPE_CHUNK = 8  # minimum frames rendered by a worker at a time in pipe mode
+CHUNK_SECONDS = 4  # target length of the chunks encoded separately
+DPI = 100
+LINE_WIDTH = round(1.5 * DPI / 72)  # LineCollection default, 1.5 pt
+RADIUS = np.sqrt(20.0) / 2 * DPI / 72  # scatter s=20 pt^2
+
+
+def trajectory_state(traj_path):
+    """[path, size, mtime] of every file the trajectory is loaded from: the
+    trajectory, its split format copy and its correction journal"""
+    files = []
+    for path in (traj_path, split_path(traj_path), journal_path(traj_path)):
+        if isfile(path):
+            files.append(path)
+        for root, _, names in walk(path):
+            files += [join(root, name) for name in sorted(names)]
+    return [[path, stat(path).st_size, stat(path).st_mtime_ns] for path in files]
+
+
+def dynamic_zoom(pos, xmin, xmax, ymin, ymax):
+    """(frames, 4) array with the (x_min, x_max, y_min, y_max) window of the
+    dynamic zoom, around the smoothed center of mass of the fish"""
     with catch_warnings():
         simplefilter("ignore", category=RuntimeWarning)
         c_mass = np.nanmean(pos, axis=1)
@@ -121,115 +206,419 @@ if args.z:
     x_max = np.clip(x_min + 2 * zoom * z_radi, None, xmax)
     y_max = np.clip(y_min + 2 * zoom * z_radi, None, ymax)
 
-    x_min = gaussian_filter1d(x_min, sigma=10)
-    y_min = gaussian_filter1d(y_min, sigma=10)
-    x_max = gaussian_filter1d(x_max, sigma=10)
-    y_max = gaussian_filter1d(y_max, sigma=10)
-
-    c_mass = None
-    z_radi = None
-
-
-# PREPARING PLOT LINES "SEGMENTS"
-temp = pos.reshape(-1, N, 1, 2)
-segments = np.concatenate([temp[:-1], temp[1:]], axis=2)
-temp = None
-
-
-# DISTRIBUTE FRAMES TO PROCESS BETWEEN THREADS
-output_frames = int(args.t * fps) if args.t else n_frames
-frame_limits = np.linspace(0, output_frames, args.n + 1, dtype=int)
-frame_limits = np.column_stack([frame_limits[:-1], frame_limits[1:]])
+    return np.column_stack(
+        [gaussian_filter1d(lim, sigma=10) for lim in (x_min, x_max, y_min, y_max)]
+    )
 
 
-# INITIALIZING FIGURE
-dpi = 100
-if args.z:
-    fig = Figure(figsize=(15, 15), dpi=dpi)
-else:
-    Lx = xmax - xmin
-    Ly = ymax - ymin
-    diag = np.sqrt(Lx * Lx + Ly * Ly) / np.sqrt(2)
-    fig = Figure(figsize=(15 * Lx / diag, 15 * Ly / diag), dpi=dpi)
+class trajectory_renderer:
+    """Renders the frames of the composed video (the original video with the
+    trajectories overlapped) with matplotlib or OpenCV.
 
-fig.patch.set_facecolor("black")
-axs = fig.add_axes([0, 0, 1, 1], facecolor="k", xticks=(), yticks=())
-axs.set(xticks=(), yticks=(), xlim=(xmin, xmax), ylim=(ymax, ymin))
+    The trajectory is mapped read-only and the figure is built the first time
+    they are used. Pickling (to send the renderer to worker processes) keeps
+    only the parameters and the dynamic zoom windows, so every worker maps
+    the trajectory file itself instead of relying on forked globals.
+    """
 
-# colors = cmap((pos[0, :, 0] > 2000).astype(float) * 0.5)
-colors = cmap(np.arange(N) / N)
+    def __init__(
+        self,
+        traj_path,
+        video_path,
+        zoom=False,
+        vmin=0,
+        vmax=255,
+        engine="matplotlib",
+        keyframes=None,
+        downscale=False,
+    ):
+        self.traj_path = traj_path
+        self.video_path = video_path
+        self.zoom = zoom
+        self.vmin = vmin
+        self.vmax = vmax
+        self.engine = engine
+        self.keyframes = keyframes
+        self.downscale = downscale
+        self.lut = gray_lut(vmin, vmax)
+
+        cap = cv2.VideoCapture(video_path)
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.nx = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.ny = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+
+        self.data = None
+        self.zoom_windows = None
+        self.figure = None
+
+    def params(self):
+        """Everything that changes the rendered frames"""
+        return {
+            "trajectory": trajectory_state(self.traj_path),
+            "video": video_fingerprint(self.video_path),
+            "zoom": self.zoom,
+            "vmin": self.vmin,
+            "vmax": self.vmax,
+            "engine": self.engine,
+            "downscale": self.downscale,
+        }
+
+    # the trajectory and the figure are reloaded in the receiving process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(data=None, figure=None)
+        return state
+
+    def load(self):
+        if self.data is None:
+            self.data = load_trajectory(self.traj_path, mmap_mode="r")
+        return self.data
+
+    @property
+    def pos(self):
+        return self.load()["trajectories"]
+
+    @property
+    def box(self):
+        """(xmin, xmax, ymin, ymax) of the outer corners of the setup"""
+        corners = self.load()["setup_points"]["corners_out"]
+        return (
+            int(np.min(corners[:, 0])),
+            int(np.max(corners[:, 0])),
+            int(np.min(corners[:, 1])),
+            int(np.max(corners[:, 1])),
+        )
 
-points = axs.scatter(*np.zeros((2, N)), c=colors, s=20.0)
+    @property
+    def size(self):
+        """(width, height) of the output frames (even, as yuv420p needs)"""
+        if self.zoom:
+            inches = np.array((15, 15))
+        else:
+            xmin, xmax, ymin, ymax = self.box
+            Lx = xmax - xmin
+            Ly = ymax - ymin
+            diag = np.sqrt(Lx * Lx + Ly * Ly) / np.sqrt(2)
+            inches = np.array((15 * Lx / diag, 15 * Ly / diag))
+        width, height = (2 * (inches * DPI // 2)).astype(int)
+        return int(width), int(height)
+
+    @property
+    def colors(self):
+        N = self.pos.shape[1]
+        return cmap(np.arange(N) / N)
+
+    def limits(self, frame):
+        """Visible region (x0, x1, y0, y1) of the video at frame"""
+        if not self.zoom:
+            return self.box
+        if self.zoom_windows is None:
+            self.zoom_windows = dynamic_zoom(self.pos, *self.box)
+        return tuple(self.zoom_windows[frame])
+
+    def build_figure(self):
+        """matplotlib figure (drawn on an Agg canvas) and its artists"""
+        width, height = self.size
+        xmin, xmax, ymin, ymax = self.box
+        colors = self.colors
+
+        # Agg truncates the figure size in pixels, the half pixel avoids rounding down
+        fig = Figure(figsize=((width + 0.5) / DPI, (height + 0.5) / DPI), dpi=DPI)
+        fig.patch.set_facecolor("black")
+        axs = fig.add_axes([0, 0, 1, 1], facecolor="k", xticks=(), yticks=())
+        axs.set(xticks=(), yticks=(), xlim=(xmin, xmax), ylim=(ymax, ymin))
+
+        points = axs.scatter(*np.zeros((2, len(colors))), c=colors, s=20.0)
+
+        # Frames are already gray levels (see prepare_frame), cropped to the view
+        im = axs.imshow(
+            np.zeros((1, 1), np.uint8), origin="upper", cmap="gray", vmax=255, vmin=0
+        )
 
-im = axs.imshow(
-    np.zeros((ny, nx)), origin="upper", cmap="gray", vmax=args.vmax, vmin=args.vmin
-)
+        LineCollections = []  # DON'T ASK...
+        for fish_color in colors:
+            color = np.tile(fish_color, (line_lenght, 1))
+            color[:, -1] = np.linspace(0, 1, line_lenght)
+            LineCollections.append(axs.add_collection(LineCollection([], color=color)))
+
+        return {
+            "canvas": FigureCanvasAgg(fig),
+            "axs": axs,
+            "points": points,
+            "im": im,
+            "lines": LineCollections,
+        }
+
+    def draw_matplotlib(self, frame, image):
+        if self.figure is None:
+            self.figure = self.build_figure()
+        figure = self.figure
+
+        width, height = self.size
+        limits = self.limits(frame)
+        if self.zoom:
+            x0, x1, y0, y1 = limits
+            figure["axs"].set(xlim=(x0, x1), ylim=(y1, y0))
+
+        figure["points"].set_offsets(self.pos[frame])
+
+        transform = view_transform(*limits, width, height)
+        region, output = visible_region(transform, width, height, self.nx, self.ny)
+        x0, x1, y0, y1 = region
+        visible = x1 > x0 and y1 > y0
+        if visible:
+            size = (output[1] - output[0], output[3] - output[2])
+            downscale = self.downscale and size[0] < x1 - x0
+            figure["im"].set_data(
+                prepare_frame(image, region, self.lut, size if downscale else None)
+            )
+            figure["im"].set_extent((x0 - 0.5, x1 - 0.5, y1 - 0.5, y0 - 0.5))
+        figure["im"].set_visible(visible)
+
+        trail = self.pos[max(0, frame - line_lenght) : frame + 1]
+        segments = np.stack([trail[:-1], trail[1:]], axis=2)
+        for fish, lines in enumerate(figure["lines"]):
+            lines.set_segments(segments[:, fish])
+
+        figure["canvas"].draw()
+        return np.asarray(figure["canvas"].buffer_rgba())[:height, :width, 2::-1]
+
+    def draw_opencv(self, frame, image):
+        width, height = self.size
+        transform = view_transform(*self.limits(frame), width, height)
+        canvas = rasterize_background(image, transform, width, height, self.lut)
+        return rasterize_trajectories(
+            canvas,
+            self.pos[max(0, frame - line_lenght) : frame + 1],
+            [tuple(255 * color[2::-1]) for color in self.colors],
+            transform,
+            LINE_WIDTH,
+            RADIUS,
+        )
 
-LineCollections = []  # DON'T ASK...
-for i in range(N):
-    color = np.tile(colors[i], (line_lenght, 1))
-    color[:, -1] = np.linspace(0, 1, line_lenght)
-    LineCollections.append(axs.add_collection(LineCollection([], color=color)))
+    def frames(self, start, finish, reader=None):
+        """Yields the rendered (height, width, 3) BGR frames from start to finish.
+        The video is read with reader (a sequential_reader of the video, so
+        that it can be kept between calls) or with a new one"""
+        draw = self.draw_opencv if self.engine == "opencv" else self.draw_matplotlib
+        own_reader = reader is None
+        if own_reader:
+            reader = sequential_reader(self.video_path, self.keyframes)
+        for frame in range(start, finish):
+            yield draw(frame, reader.read(frame))
+        if own_reader:
+            reader.release()
+
+
+def ffmpeg_writer(filename, width, height, fps):
+    """ffmpeg process encoding the raw BGR frames written to its stdin"""
+    return Popen(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            "-pix_fmt",
+            "yuv420p",
+            filename,
+        ],
+        stdin=PIPE,
+        stderr=PIPE,
+    )
 
 
-def thread_run(thread):
+def close_writer(ffmpeg, filename):
+    """Waits for an ffmpeg_writer to finish. If ffmpeg failed, the incomplete
+    file is removed and its errors are raised"""
+    try:
+        ffmpeg.stdin.close()
+    except BrokenPipeError:
+        pass
+    if ffmpeg.wait() != 0:
+        error = ffmpeg.stderr.read().decode(errors="replace").strip()
+        if exists(filename):
+            remove(filename)
+        raise RuntimeError(f"ffmpeg failed encoding {filename}: {error}")
+
+
+def kill_writer(ffmpeg, filename):
+    """Stops an ffmpeg_writer after a rendering error and removes its file"""
+    ffmpeg.kill()
+    ffmpeg.wait()
+    if exists(filename):
+        remove(filename)
+
+
+# State of every rendering worker process, set by init_worker
+worker = {}
+
+
+def init_worker(renderer):
+    worker["renderer"] = renderer
+    # Kept for the whole pool, consecutive chunks don't reopen and seek the video
+    worker["reader"] = sequential_reader(renderer.video_path, renderer.keyframes)
+
+
+def render_part(job):
+    """Encodes the frames [start, finish) into filename"""
+    start, finish, filename = job
+    renderer = worker["renderer"]
+    ffmpeg = ffmpeg_writer(filename, *renderer.size, renderer.fps)
+    try:
+        for image in renderer.frames(start, finish, worker["reader"]):
+            ffmpeg.stdin.write(np.ascontiguousarray(image).data)
+    except BrokenPipeError:
+        pass  # ffmpeg exited, close_writer raises its error
+    except BaseException:
+        kill_writer(ffmpeg, filename)
+        raise
+    close_writer(ffmpeg, filename)
+    return start, finish
+
+
+def render_chunk(chunk):
+    """Raw BGR bytes of the frames [start, finish) of a chunk"""
+    start, finish = chunk
+    return [
+        np.ascontiguousarray(image).tobytes()
+        for image in worker["renderer"].frames(start, finish, worker["reader"])
+    ]
+
+
+def pipe_run(renderer, output, n_frames, n_cores):
+    """Renders the video in small chunks of frames and streams them, in
+    order, to a single ffmpeg process.
+
+    Chunks start at keyframes when they are close enough (see split_chunks)
+    and every worker keeps its video reader between chunks, so a chunk
+    doesn't decode frames of the previous one to get to its first frame.
+
+    Chunks are rendered by the pool in any order and wait in a reorder
+    buffer until every previous chunk has been written. Only max_chunks
+    chunks are rendered or waiting at a time, so the memory is bounded and
+    ffmpeg encodes while the workers keep rendering.
     """
-    This function runs in every thread generating a portion of the final video
+    chunks = split_chunks(n_frames, PIPE_CHUNK, renderer.keyframes)
+    max_chunks = 2 * n_cores
+    ffmpeg = ffmpeg_writer(output, *renderer.size, renderer.fps)
+    try:
+        with Pool(n_cores, initializer=init_worker, initargs=(renderer,)) as p, tqdm(
+            total=n_frames, desc="Rendering"
+        ) as progress:
+            pending = {}  # chunk index -> AsyncResult
+            for index in range(len(chunks)):
+                last = min(index + max_chunks, len(chunks))
+                for ahead in range(index + len(pending), last):
+                    pending[ahead] = p.apply_async(render_chunk, (chunks[ahead],))
+                for image in pending.pop(index).get():
+                    ffmpeg.stdin.write(image)
+                    progress.update()
+    except BrokenPipeError:
+        pass  # ffmpeg exited, close_writer raises its error
+    except BaseException:
+        kill_writer(ffmpeg, output)
+        raise
+    close_writer(ffmpeg, output)
+
+
+def split_chunks(n_frames, chunk_length, keyframes=None):
+    """[start, finish) chunks of about chunk_length frames covering n_frames.
+
+    With a keyframe index, chunks start at keyframes so that no worker decodes
+    frames of the previous chunk to get to its first frame. Keyframes more
+    than 2 * chunk_length apart are split anyway.
     """
-    start, finish = frame_limits[thread]
-    n_frames = finish - start
-
-    cap = cv2.VideoCapture(args.video)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
-
-    def animate(video_frame_in_this_thread):
-        """
-        This animates the FuncAnimation
-        """
-        global_frame = video_frame_in_this_thread + start
-
-        if args.z:
-            axs.set(
-                xlim=(x_min[global_frame], x_max[global_frame]),
-                ylim=(y_max[global_frame], y_min[global_frame]),
-            )
-
-        points.set_offsets(pos[global_frame])
-        im.set_data(np.mean(cap.read()[1], axis=2))
-
-        origin = max(0, global_frame - line_lenght)
-        for fish in range(N):
-            LineCollections[fish].set_segments(segments[origin:global_frame, fish])
-        return
-
-    ani = FuncAnimation(
-        fig,
-        animate,
-        frames=trange(
-            n_frames,
-            total=n_frames - 1,
-            position=thread,
-            desc=f"Thread {thread}",
-        ),
-        init_func=lambda: 0,
+    keyframes = [] if keyframes is None else keyframes
+    starts = [0]
+    for keyframe in [int(k) for k in keyframes if 0 < k < n_frames] + [n_frames]:
+        while keyframe - starts[-1] > 2 * chunk_length:
+            starts.append(starts[-1] + chunk_length)
+        if keyframe - starts[-1] >= chunk_length and keyframe < n_frames:
+            starts.append(keyframe)
+    bounds = starts + [n_frames]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def finished_chunks(folder, plan):
+    """Chunks already encoded in folder by a previous render with the same
+    plan. Otherwise, the folder is (re)started for the given plan"""
+    plan_path = join(folder, "plan.json")
+    try:
+        with open(plan_path) as file:
+            same_plan = json.load(file) == plan
+        with open(join(folder, "finished.txt")) as file:
+            finished = [tuple(map(int, line.split())) for line in file]
+    except (OSError, ValueError):
+        same_plan = False
+
+    if same_plan:
+        return {
+            chunk for chunk in finished if exists(chunk_filename(folder, *chunk))
+        }
+
+    rmtree(folder, ignore_errors=True)
+    makedirs(folder)
+    with open(plan_path, "w") as file:
+        json.dump(plan, file)
+    return set()
+
+
+def chunk_filename(folder, start, finish):
+    return abspath(join(folder, f"chunk_{start:07d}_{finish:07d}.mp4"))
+
+
+def parts_run(renderer, output, n_frames, n_cores):
+    """Renders the video in small chunks (one file each) and joins them with
+    the concat demuxer.
+
+    Chunks are handed to the workers from a queue, largest first, so a slow
+    chunk doesn't hold up the others. Finished chunks are recorded in a
+    folder next to the output and an interrupted render resumes from them
+    when run again with the same parameters.
+    """
+    folder = splitext(output)[0] + "_parts"
+    chunks = split_chunks(
+        n_frames, max(1, int(CHUNK_SECONDS * renderer.fps)), renderer.keyframes
     )
-
-    filename = f"{tmp_folder}part{thread:02d}.mp4"
-    ani.save(filename, fps=fps)
-    return filename
-
-
-rmtree(tmp_folder, ignore_errors=True)
-makedirs(tmp_folder)
-
-
-def main():
-    with Pool(args.n) as p, open("files.txt", "w") as file:
-        for filename in p.map(thread_run, range(args.n)):
-            file.write("file " + filename + "\n")
-    print("\n" * args.n)
-
-    call(
+    plan = json.loads(json.dumps({**renderer.params(), "chunks": chunks}))
+    finished = finished_chunks(folder, plan)
+    if finished:
+        print(f"Resuming render, {len(finished)}/{len(chunks)} chunks in {folder}")
+
+    jobs = [
+        (start, finish, chunk_filename(folder, start, finish))
+        for start, finish in sorted(chunks, key=lambda chunk: chunk[0] - chunk[1])
+        if (start, finish) not in finished
+    ]
+    with Pool(n_cores, initializer=init_worker, initargs=(renderer,)) as p, open(
+        join(folder, "finished.txt"), "a"
+    ) as log, tqdm(
+        total=n_frames,
+        initial=sum(finish - start for start, finish in finished),
+        desc="Rendering",
+    ) as progress:
+        for start, finish in p.imap_unordered(render_part, jobs):
+            log.write(f"{start} {finish}\n")
+            log.flush()
+            progress.update(finish - start)
+
+    with open(join(folder, "files.txt"), "w") as file:
+        for start, finish in chunks:
+            file.write("file " + chunk_filename(folder, start, finish) + "\n")
+
+    joined = call(
         [
             "ffmpeg",
             "-safe",
@@ -241,15 +630,140 @@ def main():
             "concat",
             "-y",
             "-i",
-            "files.txt",
+            join(folder, "files.txt"),
             "-c",
             "copy",
-            args.o if args.o else splitext(args.video)[0] + "_tracked.mp4",
+            output,
         ]
     )
+    if joined != 0:
+        raise RuntimeError(f"ffmpeg failed joining the chunks (kept in {folder})")
+    rmtree(folder)
+
+
+def render(
+    session,
+    video,
+    output=None,
+    duration=None,
+    zoom=False,
+    vmin=0,
+    vmax=255,
+    engine="matplotlib",
+    pipe=False,
+    n_cores=4,
+    downscale=False,
+):
+    """Renders the composed video of an idTracker.ai session (directory or
+    trajectory file) over its video. Returns the output file path.
+
+    duration is in seconds (default is the entire video), see main for the
+    rest of the parameters.
+    """
+    traj_path = trajectory_path(session, read_only=True)
+    renderer = trajectory_renderer(
+        traj_path,
+        video,
+        zoom,
+        vmin,
+        vmax,
+        engine,
+        keyframes=keyframe_index(video, dirname(traj_path)),
+        downscale=downscale,
+    )
+    output = output if output else splitext(video)[0] + "_tracked.mp4"
+    n_frames = int(duration * renderer.fps) if duration else len(renderer.pos)
+    renderer.limits(0)  # the zoom windows are computed once, before the workers
+
+    run = pipe_run if pipe else parts_run
+    run(renderer, output, n_frames, n_cores)
+    return output
+
+
+def main():
+    parser = ArgumentParser(
+        description="Renders a composed video with the trajectories overlapping the original video. It uses matplotlib with multiprocessing."
+    )
+
+    parser.add_argument(
+        "s",
+        metavar="session",
+        type=str,
+        help="idTracker.ai successful session directory or trajectory file",
+    )
+    parser.add_argument(
+        "video",
+        type=file_path,
+        help="Video file (only one file)",
+    )
+
+    parser.add_argument(
+        "-o",
+        metavar="output",
+        type=str,
+        help="Output file name, default is (video path)_tracked.mp4",
+    )
+    parser.add_argument(
+        "-t",
+        metavar="time",
+        type=float,
+        help="Duration of the tracked video (in seconds), default is entire video",
+    )
+    parser.add_argument(
+        "-z",
+        action="store_true",
+        default=False,
+        help="Activates dynamic zoom in the video",
+    )
+
+    parser.add_argument(
+        "-vmin",
+        type=float,
+        default=0,
+        help="Minimum value for video colormap, default 0",
+    )
 
-    rmtree(tmp_folder)
-    remove("files.txt")
+    parser.add_argument(
+        "-vmax",
+        type=float,
+        default=255,
+        help="Maximum value for video colormap, default 255",
+    )
+    parser.add_argument(
+        "-engine",
+        choices=("matplotlib", "opencv"),
+        default="matplotlib",
+        help="Rendering engine, opencv draws directly on the video frames (much faster). Default is matplotlib",
+    )
+    parser.add_argument(
+        "-pipe",
+        action="store_true",
+        default=False,
+        help="Streams the rendered frames in order to a single ffmpeg process instead of encoding one part per thread and joining them",
+    )
+    parser.add_argument(
+        "-downscale",
+        action="store_true",
+        default=False,
+        help="Resizes the visible region of the frames to the output resolution before drawing them with matplotlib (faster). The opencv engine always does",
+    )
+    parser.add_argument("-n", type=int, default=4, help="number of threads. Default is 4")
+
+    args = parser.parse_args()
+
+    render(
+        args.s,
+        args.video,
+        output=args.o,
+        duration=args.t,
+        zoom=args.z,
+        vmin=args.vmin,
+        vmax=args.vmax,
+        engine=args.engine,
+        pipe=args.pipe,
+        n_cores=args.n,
+        downscale=args.downscale,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import threading
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+# Decoding costs in units of "one decoded and processed frame".
+# A seek decodes from the previous keyframe (about half a GOP on average),
+# cap.grab() decodes without retrieving nor processing the image.
+SEEK_COST = 30
+GRAB_COST = 0.5
+MAX_GAP = int(SEEK_COST / GRAB_COST)
+MAX_JOB_COST = 4 * SEEK_COST
+
+
+def group_frames(frames, max_gap=MAX_GAP):
+    """Splits the needed frames into runs decoded sequentially. Needed frames
+    closer than max_gap belong to the same run (the frames in between are
+    grabbed instead of seeking over them)"""
+    frames = np.unique(np.asarray(frames, dtype=np.int64))
+    if not len(frames):
+        return []
+    return np.split(frames, np.nonzero(np.diff(frames) > max_gap)[0] + 1)
+
+
+def decode_cost(run):
+    n_grabbed = run[-1] - run[0] + 1 - len(run)
+    return SEEK_COST + len(run) + GRAB_COST * n_grabbed
+
+
+def split_runs(runs, max_cost=MAX_JOB_COST):
+    """Splits the costly runs so that a long episode is decoded by several
+    workers at once"""
+    pieces = []
+    for run in runs:
+        n_pieces = min(len(run), int(decode_cost(run) // max_cost) + 1)
+        pieces += np.array_split(run, n_pieces)
+    return pieces
+
+
+class sequential_reader:
+    """cv2.VideoCapture for frames read in (mostly) increasing order. It only
+    seeks when grabbing forward would be more expensive than seeking.
+
+    With a keyframe index (see keyframes.keyframe_index), it seeks to the
+    keyframe before the frame and grabs forward from there, so a random
+    access never decodes more than one GOP.
+    """
+
+    def __init__(self, video_path, keyframes=None):
+        self.cap = cv2.VideoCapture(video_path)
+        self.keyframes = keyframes
+        self.position = 0  # frame returned by the next cap.read()
+
+    def read(self, frame):
+        if self.keyframes is None:
+            target = frame
+            seek = (
+                frame < self.position
+                or (frame - self.position) * GRAB_COST > SEEK_COST
+            )
+        else:
+            target = int(
+                self.keyframes[
+                    max(0, np.searchsorted(self.keyframes, frame, side="right") - 1)
+                ]
+            )
+            seek = not target <= self.position <= frame
+        if seek:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            self.position = target
+        for _ in range(frame - self.position):
+            self.cap.grab()
+        ret, image = self.cap.read()
+        assert ret
+        self.position = frame + 1
+        return image
+
+    def release(self):
+        self.cap.release()
+
+
+# State of every prefetcher worker process, set by init_worker
+worker = {}
+
+
+def init_worker(frame_store, video_path, process_fun, lims, keyframes):
+    worker["frame_store"] = frame_store
+    worker["reader"] = sequential_reader(video_path, keyframes)
+    worker["process_fun"] = process_fun
+    worker["lims"] = lims
+
+
+def load_run(run):
+    frame_store = worker["frame_store"]
+    for frame in frame_store.missing(run):
+        image = worker["reader"].read(frame)
+        frame_store.write(frame, worker["process_fun"](image, *worker["lims"]))
+
+
+class prefetcher:
+    """Loads frames into a frame_store in the background with a pool of
+    worker processes.
+
+    Frames are requested in groups (one per episode) and decoded in request
+    order, with priority requests going before everything else. Only a few
+    runs are sent to the pool at a time so that priorities take effect
+    quickly. The GUI checks status() instead of waiting for a decode.
+    """
+
+    def __init__(
+        self, frame_store, video_path, process_fun, lims, n_workers=4, keyframes=None
+    ):
+        self.frame_store = frame_store
+        self.max_in_flight = 2 * n_workers
+        self.queue = deque()  # runs waiting to be sent to the pool
+        self.queued = set()  # frames requested and not loaded yet
+        self.in_flight = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.pool = Pool(
+            n_workers,
+            initializer=init_worker,
+            initargs=(frame_store, video_path, process_fun, lims, keyframes),
+        )
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def request(self, groups_of_frames, priority=False):
+        """Requests every group of frames (in order). Priority requests are
+        loaded before any other pending request. Only the first frames that
+        fit in the store are requested, the rest would be dropped anyway"""
+        runs = []
+        budget = self.frame_store.capacity
+        with self.condition:
+            for frames in groups_of_frames:
+                frames = self.frame_store.missing(np.unique(frames))
+                if not priority:
+                    frames = np.array(
+                        [frame for frame in frames.tolist() if frame not in self.queued],
+                        dtype=np.int64,
+                    )
+                frames = frames[:budget]
+                budget -= len(frames)
+                if len(frames):
+                    runs += split_runs(group_frames(frames))
+                    self.queued.update(frames.tolist())
+            if not runs:
+                return
+            self.frame_store.allocate(np.concatenate(runs))
+            if priority:
+                self.queue.extendleft(reversed(runs))
+            else:
+                self.queue.extend(runs)
+            self.condition.notify()
+
+    def status(self, frame):
+        """One of "ready", "loading" or "missing" (never requested)"""
+        if frame in self.frame_store:
+            return "ready"
+        if frame in self.queued:
+            return "loading"
+        return "missing"
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while not self.closed and (
+                    not self.queue or self.in_flight >= self.max_in_flight
+                ):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                run = self.queue.popleft()
+                self.in_flight += 1
+            self.pool.apply_async(
+                load_run,
+                (run,),
+                callback=partial(self.done, run),
+                error_callback=partial(self.done, run),
+            )
+
+    def done(self, run, error=None):
+        if error is not None:
+            print(f"Error loading frames {run[0]} => {run[-1]}: {error}")
+        with self.condition:
+            self.in_flight -= 1
+            self.queued.difference_update(run.tolist())
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.pool.terminate()
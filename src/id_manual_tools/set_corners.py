@@ -2,12 +2,15 @@ import matplotlib.pyplot as plt
 import numpy as np
 import cv2
 from rich import print
-from functools import lru_cache
 import os
 from rich.console import Console
 from id_manual_tools.matplotlib_gui import matplotlib_gui
+from id_manual_tools.frame_lru import frame_lru
+from id_manual_tools.preloader import sequential_reader
+from id_manual_tools.keyframes import keyframe_index
 from rich.table import Table
 from id_manual_tools.utils import trajectory_path
+from id_manual_tools.trajectory_io import load_trajectory, correction_journal
 from argparse import ArgumentParser
 from rich.align import Align
 
@@ -16,9 +19,11 @@ console = Console()
 
 
 class setup_points_setter(matplotlib_gui):
-    def __init__(self, video_path, data, name):
+    def __init__(self, video_path, data, name, memory_cache=500, keyframes=None):
 
         self.cap = cv2.VideoCapture(video_path)
+        self.reader = sequential_reader(video_path, keyframes)
+        self.frame_lru = frame_lru(memory_cache)
         self.total_frames = self.cap.get(cv2.CAP_PROP_FRAME_COUNT)
         print(f"Loaded {os.path.abspath(video_path)}")
 
@@ -59,7 +64,7 @@ class setup_points_setter(matplotlib_gui):
             self.text.set_text(f"Frame {self.frame}")
             self.actual_plotted_frame = self.frame
 
-        self.draw_and_flush()
+        self.blit_and_flush()
 
     def create_figure(self):
 
@@ -87,6 +92,8 @@ class setup_points_setter(matplotlib_gui):
             0.1, 0.1, "", size=15, transform=self.ax.transAxes, zorder=15
         )
 
+        self.add_animated(self.im, self.text, *self.lines.values())
+
     @staticmethod
     def close_line(x, y):
         if len(x) < 3:
@@ -116,15 +123,11 @@ class setup_points_setter(matplotlib_gui):
         print(f"[green]Data writed in trajectory file")
         plt.close()
 
-    @lru_cache(maxsize=20)
     def get_frame(self, frame):
+        return self.frame_lru.get(frame, self.read_frame)
 
-        if self.cap.get(cv2.CAP_PROP_POS_FRAMES) != frame:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
-        ret, image = self.cap.read()
-        assert ret
-
-        return image
+    def read_frame(self, frame):
+        return self.reader.read(frame)
 
     @staticmethod
     def closest_point(x, y, xs, ys):
@@ -196,13 +199,14 @@ def setup_points_table(setup_points):
     return table
 
 
-def arg_main(video_path, data):
+def arg_main(video_path, data, memory_cache=500, keyframes=None):
     console.rule("Welcome to the setup_points setter!")
 
     if isinstance(data, str):
         input_arg = "path"
-        path = trajectory_path(data)
-        data = np.load(path, allow_pickle=True).item()
+        path = trajectory_path(data, read_only=True)
+        data = load_trajectory(path, mmap_mode="r")
+        keyframes = keyframe_index(video_path, os.path.dirname(path))
     else:
         input_arg = "data"
 
@@ -217,8 +221,9 @@ def arg_main(video_path, data):
         )
         if what_to_do == "q":
             if input_arg == "path":
-                np.save(path, data)
-                console.print(f"Data saved to {path}")
+                journal = correction_journal(path)
+                journal.set_entry("setup_points", data["setup_points"])
+                console.print(f"Data saved to {journal.path}")
             console.rule("bye!")
             return
         elif what_to_do == "rename":
@@ -226,7 +231,13 @@ def arg_main(video_path, data):
         elif what_to_do == "delete":
             delete_setup_point(data["setup_points"])
         elif what_to_do:
-            setup_points_setter(video_path, data, name=what_to_do)
+            setup_points_setter(
+                video_path,
+                data,
+                name=what_to_do,
+                memory_cache=memory_cache,
+                keyframes=keyframes,
+            )
 
 
 def main():
@@ -234,7 +245,7 @@ def main():
     parser.add_argument(
         "s",
         metavar="session",
-        type=trajectory_path,
+        type=str,
         help="idTracker.ai successful session directory or trajectory file",
     )
     parser.add_argument(
@@ -242,8 +253,14 @@ def main():
         type=str,
         help="Video file (only one file)",
     )
+    parser.add_argument(
+        "-memory_cache",
+        type=float,
+        default=500,
+        help="Memory budget for frames kept in RAM, in MB. Default is 500",
+    )
     args = parser.parse_args()
-    arg_main(args.video, args.s)
+    arg_main(args.video, args.s, memory_cache=args.memory_cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+import os
+import json
+import struct
+import numpy as np
+
+SPLIT_SUFFIX = ".traj"
+METADATA_FILE = "metadata.json"
+JOURNAL_MAGIC = b"IDMTJ001"
+
+
+def split_path(path):
+    """Returns the split-format directory associated to a pickled trajectory file
+
+    trajectories_wo_gaps.npy -> trajectories_wo_gaps.traj
+    """
+    if path.endswith(".npy"):
+        path = path[:-4]
+    return path + SPLIT_SUFFIX
+
+
+def is_split_trajectory(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, METADATA_FILE))
+
+
+def is_pickled_trajectory(path):
+    """Checks the .npy header (without unpickling) for a 0-d object array,
+    which is how idtracker.ai stores its trajectory dict"""
+    try:
+        with open(path, "rb") as file:
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(file)
+    except (OSError, ValueError):
+        return False
+    return shape == () and dtype.hasobject
+
+
+def _encode(value):
+    """JSON encoding for the small (non-array) entries of the trajectory dict.
+    Raises TypeError if the value is not representable"""
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return {"__ndarray__": value.tolist(), "dtype": value.dtype.str}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {k: _encode(v) for k, v in value.items()}
+    raise TypeError(f"Not JSON serializable: {type(value)}")
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if "__ndarray__" in value:
+            return np.array(value["__ndarray__"], dtype=value["dtype"])
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+
+def _save_npy(path, array):
+    # Written to a temporary file and renamed so that memory-mapped readers
+    # of the previous version keep a valid inode
+    with open(path + ".tmp", "wb") as file:
+        np.save(file, array)
+    os.replace(path + ".tmp", path)
+
+
+def save_split(path, data):
+    """Writes a trajectory dict in the split format: one raw .npy per array
+    (memory-mappable) plus a metadata.json with the rest of the entries"""
+    os.makedirs(path, exist_ok=True)
+    metadata = {"keys": list(data), "arrays": [], "objects": [], "values": {}}
+
+    for key, value in data.items():
+        if isinstance(value, np.ndarray) and value.ndim and not value.dtype.hasobject:
+            _save_npy(os.path.join(path, key + ".npy"), value)
+            metadata["arrays"].append(key)
+            continue
+        try:
+            metadata["values"][key] = _encode(value)
+        except TypeError:
+            obj = np.empty((), dtype=object)
+            obj[()] = value
+            _save_npy(os.path.join(path, key + ".npy"), obj)
+            metadata["objects"].append(key)
+
+    metadata_path = os.path.join(path, METADATA_FILE)
+    with open(metadata_path + ".tmp", "w") as file:
+        json.dump(metadata, file)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def load_split(path, mmap_mode=None):
+    with open(os.path.join(path, METADATA_FILE), "r") as file:
+        metadata = json.load(file)
+
+    data = {key: _decode(value) for key, value in metadata["values"].items()}
+    for key in metadata["arrays"]:
+        data[key] = np.load(os.path.join(path, key + ".npy"), mmap_mode=mmap_mode)
+    for key in metadata["objects"]:
+        data[key] = np.load(os.path.join(path, key + ".npy"), allow_pickle=True)[()]
+    return {key: data[key] for key in metadata["keys"]}
+
+
+def load_trajectory(path, mmap_mode=None, apply_corrections=True):
+    """Loads a trajectory dict from an idtracker.ai pickled .npy file or from
+    a split-format directory.
+
+    Pickled files are converted to the split format the first time they are
+    loaded (if the directory is writable) so that later loads only map the
+    arrays that are actually used.
+
+    If the file has a correction journal, it is replayed on top of the loaded
+    data (read-only maps are opened copy-on-write for that).
+    """
+    journal = correction_journal(path)
+    if apply_corrections and journal.exists():
+        data = _load_trajectory(path, "c" if mmap_mode == "r" else mmap_mode)
+        print(f"Applied {journal.replay(data)} corrections from {journal.path}")
+        return data
+    return _load_trajectory(path, mmap_mode)
+
+
+def _load_trajectory(path, mmap_mode):
+    if is_split_trajectory(path):
+        return load_split(path, mmap_mode)
+
+    split = split_path(path)
+    if is_split_trajectory(split) and os.path.getmtime(
+        os.path.join(split, METADATA_FILE)
+    ) >= os.path.getmtime(path):
+        return load_split(split, mmap_mode)
+
+    data = np.load(path, allow_pickle=True).item()
+    try:
+        save_split(split, data)
+    except OSError:
+        return data
+    print(f"Converted {path} to split format at {split}")
+    if mmap_mode is None:
+        return data
+    return load_split(split, mmap_mode)
+
+
+def save_trajectory(path, data):
+    """Saves a trajectory dict. Split-format directories are written array by
+    array, pickled files are rewritten (and their split copy refreshed)"""
+    if path.endswith(SPLIT_SUFFIX) or is_split_trajectory(path):
+        save_split(path, data)
+        return
+
+    np.save(
+        path,
+        {
+            key: np.asarray(value) if isinstance(value, np.memmap) else value
+            for key, value in data.items()
+        },
+    )
+    if is_split_trajectory(split_path(path)):
+        save_split(split_path(path), data)
+
+
+def journal_path(path):
+    """trajectories_wo_gaps.npy (or .traj) -> trajectories_wo_gaps.journal"""
+    return os.path.splitext(path.rstrip(os.sep))[0] + ".journal"
+
+
+class correction_journal:
+    """Append-only log of the corrections made to a trajectory file.
+
+    The trajectory file is never rewritten, the journal is replayed on top of
+    it when loaded. Records are (kind, payload length, payload) with kinds:
+
+        POSITIONS: fish_id, start, positions[n, 2]
+            traj[start : start + n, fish_id] = positions
+        ENTRY: JSON {"key": key, "value": value}
+            data[key] = value
+
+    A truncated last record (crashed session) is ignored on replay and
+    overwritten by the next append.
+    """
+
+    POSITIONS = 0
+    ENTRY = 1
+    record_header = struct.Struct("<BQ")
+    positions_header = struct.Struct("<iq")
+
+    def __init__(self, trajectory_path):
+        self.path = journal_path(trajectory_path)
+        self.entries = {}  # last encoded value of every ENTRY key
+        self.checked_size = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def clear(self):
+        if self.exists():
+            print(f"Removing correction journal {self.path}")
+            os.remove(self.path)
+        self.entries = {}
+        self.checked_size = False
+
+    def read_records(self):
+        """Returns the list of complete (kind, payload) records and the
+        size in bytes of the valid part of the journal"""
+        try:
+            with open(self.path, "rb") as file:
+                raw = file.read()
+        except FileNotFoundError:
+            return [], 0
+
+        if len(raw) < len(JOURNAL_MAGIC):
+            return [], 0
+        if not raw.startswith(JOURNAL_MAGIC):
+            raise TypeError(f"Not a valid correction journal {self.path}")
+
+        records = []
+        offset = len(JOURNAL_MAGIC)
+        while offset + self.record_header.size <= len(raw):
+            kind, length = self.record_header.unpack_from(raw, offset)
+            end = offset + self.record_header.size + length
+            if end > len(raw):
+                break
+            records.append((kind, raw[offset + self.record_header.size : end]))
+            offset = end
+        return records, offset
+
+    def replay(self, data):
+        """Applies the journal to a (writeable) trajectory dict, returns the
+        number of records applied"""
+        records, _ = self.read_records()
+        for kind, payload in records:
+            if kind == self.POSITIONS:
+                fish_id, start = self.positions_header.unpack_from(payload)
+                positions = np.frombuffer(
+                    payload, dtype="<f8", offset=self.positions_header.size
+                ).reshape(-1, 2)
+                data["trajectories"][start : start + len(positions), fish_id] = positions
+            elif kind == self.ENTRY:
+                entry = json.loads(payload.decode())
+                self.entries[entry["key"]] = entry["value"]
+                data[entry["key"]] = _decode(entry["value"])
+        return len(records)
+
+    def append(self, kind, payload):
+        if not self.checked_size:
+            _, valid_size = self.read_records()
+            if valid_size == 0:
+                with open(self.path, "wb") as file:
+                    file.write(JOURNAL_MAGIC)
+            elif valid_size < os.path.getsize(self.path):
+                os.truncate(self.path, valid_size)
+            self.checked_size = True
+
+        with open(self.path, "ab") as file:
+            file.write(self.record_header.pack(kind, len(payload)) + payload)
+
+    def append_positions(self, fish_id, start, positions):
+        positions = np.ascontiguousarray(positions, dtype="<f8")
+        self.append(
+            self.POSITIONS,
+            self.positions_header.pack(fish_id, start) + positions.tobytes(),
+        )
+
+    def set_entry(self, key, value):
+        """Records data[key] = value, only if it changed since the last record"""
+        value = json.loads(json.dumps(_encode(value)))
+        if key in self.entries and self.entries[key] == value:
+            return
+        self.append(self.ENTRY, json.dumps({"key": key, "value": value}).encode())
+        self.entries[key] = value
+
+    def sync(self):
+        if self.exists():
+            with open(self.path, "ab") as file:
+                os.fsync(file.fileno())
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class trajectory_window:
+    """Positions of every fish except one (the fish being corrected) for the
+    frames around the displayed one.
+
+    Only a window of frames is copied from the trajectories (which can be a
+    memmap of the whole session). The window slides when the requested frame
+    (or its trail) falls outside of it.
+    """
+
+    def __init__(self, trajectories, excluded, trail=30, half_width=500):
+        self.trajectories = trajectories
+        self.fish = np.delete(np.arange(trajectories.shape[1]), excluded)
+        self.trail = trail
+        self.half_width = half_width
+        self.first = self.last = 0
+        self.pos = np.empty((0, len(self.fish), 2))
+
+    def update(self, frame):
+        """Makes the window cover the frame and its trail"""
+        if self.first <= max(0, frame - self.trail) and frame < self.last:
+            return
+        self.first = max(0, frame - self.trail - self.half_width)
+        self.last = min(len(self.trajectories), frame + self.half_width + 1)
+        self.pos = self.trajectories[self.first : self.last][:, self.fish]
+
+    def positions(self, frame):
+        """(N-1, 2) positions at frame"""
+        self.update(frame)
+        return self.pos[frame - self.first]
+
+    def segments(self, frame):
+        """(n, N-1, 2, 2) trail segments from frame - trail up to frame"""
+        self.update(frame)
+        origin = max(0, frame - self.trail) - self.first
+        trail = self.pos[origin : frame - self.first + 1]
+        return np.stack([trail[:-1], trail[1:]], axis=2)
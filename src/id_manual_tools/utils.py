@@ -1,6 +1,11 @@
 import os
-from numpy import load
-from shutil import copyfile
+from shutil import copyfile, copytree, rmtree
+from id_manual_tools.trajectory_io import is_pickled_trajectory, is_split_trajectory
+
+# Frames shown around an episode in the GUI (pad) and extra frames around it
+# used to fit the interpolator (pad_extra), shared with the headless gap filler
+EPISODE_PAD = 7
+EPISODE_PAD_EXTRA = 150
 
 # TODO. It should be okay if there is trajectories_wo_gaps_corrected.npy and no trajectories_wo_gaps.npy
 
@@ -16,12 +21,13 @@ def trajectory_path(session_path, reset=False, read_only=False):
     if not os.path.exists(session_path):
         raise TypeError(f"The path doesn't exists {session_path}")
 
+    if is_split_trajectory(session_path):
+        return get_duplicated(session_path, reset=reset, read_only=read_only)
+
     if not os.path.isdir(session_path):
-        try:
-            load(session_path, allow_pickle=True).item()
+        if is_pickled_trajectory(session_path):
             return get_duplicated(session_path, reset=reset, read_only=read_only)
-        except:
-            raise TypeError(f"Not a valid trajectory file {session_path}")
+        raise TypeError(f"Not a valid trajectory file {session_path}")
 
     path_N_particles = os.path.join(
         session_path, "trajectories_wo_gaps", "trajectories_wo_gaps.npy"
@@ -36,29 +42,37 @@ def trajectory_path(session_path, reset=False, read_only=False):
         raise TypeError(f"No trajectory file found in session {session_path}")
 
 
+def duplicate(original, copied):
+    print(f"Duplicating {original} to {copied} ")
+    if os.path.isdir(original):
+        rmtree(copied, ignore_errors=True)
+        copytree(original, copied)
+    else:
+        copyfile(original, copied)
+
+
 def get_duplicated(path, read_only, reset=True):
-    if path.endswith("_corrected.npy"):
-        original = path[:-14] + ".npy"
+    root, ext = os.path.splitext(path.rstrip(os.sep))
+    if root.endswith("_corrected"):
+        original = root[:-10] + ext
         copied = path
     else:
         original = path
-        copied = path[:-4] + "_corrected.npy"
+        copied = root + "_corrected" + ext
 
     copied_exists = os.path.exists(copied)
 
     if read_only:
         if copied_exists:
             if reset:
-                print(f"Duplicating {original} to {copied} ")
-                copyfile(original, copied)
+                duplicate(original, copied)
             return copied
         else:
             return original
 
     else:
         if not copied_exists or reset:
-            print(f"Duplicating {original} to {copied} ")
-            copyfile(original, copied)
+            duplicate(original, copied)
         return copied
 
 